@@ -35,7 +35,7 @@ battery_status() {
 
 #python parse_backup_progress.py 2>&1
 #echo -n "$(temperature)°C"
-python toggl_time_tracked.py
+python toggl_time_tracked.py --cached
 consumption_value=$(consumption)
 
 if [[ "$(battery_status)" == "Charging" ]]; then
@@ -28,4 +28,11 @@ sudo systemctl stop vpn_autoconnect.service
 sudo systemctl start vpn_autoconnect.service
 
 sudo cp etc/polkit-1/rules.d/50-org.freedesktop.NetworkManager.rules /etc/polkit-1/rules.d/
-sudo systemctl restart polkit
\ No newline at end of file
+sudo systemctl restart polkit
+
+# RSYNC BACKUP CHANGE JOURNAL
+
+sudo cp etc/systemd/system/rsync_backup_watch.service /etc/systemd/system/rsync_backup_watch.service
+sudo systemctl daemon-reload
+sudo systemctl enable rsync_backup_watch.service
+sudo systemctl restart rsync_backup_watch.service
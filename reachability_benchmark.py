@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Compares probing many targets at once in-process with forking a `ping` per target, as it was done before.
+
+All probes go through the loopback interface to loopback addresses, so the time measured is the overhead of the
+probing itself. ICMP probes need the group of the user in `net.ipv4.ping_group_range`, and the former path needs the
+`ping` binary. A method that cannot run on this machine is skipped.
+
+To run:
+
+python reachability_benchmark.py --probes 1 10 100 --runs 10
+"""
+import argparse
+import ipaddress
+import os
+import select
+import selectors
+import shutil
+import statistics
+import subprocess
+import time
+from functools import partial
+from typing import Callable, Final
+
+from shared.reachability import IcmpProbe, Probe, TcpProbe
+
+INTERFACE: Final[str] = "lo"
+TIMEOUT_SEC: Final[int] = 3
+PING_CMD: Final[str] = "ping -I {interface} -q -c 1 -w {timeout} {target}"
+
+
+def loopback_targets(count: int) -> list[str]:
+    first = ipaddress.IPv4Address("127.0.0.1")
+    return [str(first + index) for index in range(count)]
+
+
+def ping_subprocesses(targets: list[str]) -> int:
+    """The former path, a `ping` process per target whose exits are awaited through pidfds."""
+    pings = {}
+    for target in targets:
+        command = PING_CMD.format(interface=INTERFACE, target=target, timeout=TIMEOUT_SEC).split()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pings[os.pidfd_open(process.pid)] = process
+
+    replies = 0
+    while pings:
+        for pidfd in select.select(list(pings), [], [])[0]:
+            replies += pings.pop(pidfd).wait() == 0
+            os.close(pidfd)
+    return replies
+
+
+def run_probes(probe_type: Callable[[str, str], Probe], targets: list[str]) -> int:
+    replies = 0
+    with selectors.DefaultSelector() as selector:
+        for target in targets:
+            probe = probe_type(INTERFACE, target)
+            selector.register(probe, probe.events)
+
+        deadline = time.monotonic() + TIMEOUT_SEC
+        while selector.get_map() and (timeout_sec := deadline - time.monotonic()) > 0:
+            for key, _ in selector.select(timeout_sec):
+                if (success := key.fileobj.result()) is not None:
+                    replies += success
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+    return replies
+
+
+def available_methods() -> dict[str, Callable[[list[str]], int]]:
+    methods = {}
+    if shutil.which("ping"):
+        methods["ping"] = ping_subprocesses
+
+    for name, probe_type in (("icmp", IcmpProbe), ("tcp", TcpProbe)):
+        try:
+            probe_type(INTERFACE, "127.0.0.1").close()
+        except OSError as e:
+            # E.g. ICMP datagram sockets not allowed by net.ipv4.ping_group_range or binding to an interface refused
+            print(f"Skipping {name}: {e}")
+        else:
+            methods[name] = partial(run_probes, probe_type)
+
+    return methods
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--probes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    methods = available_methods()
+    print(f"{'Probes':>6} {'Method':<6} {'Median':>10} {'Min':>10} {'Replies':>8}")
+    for count in args.probes:
+        targets = loopback_targets(count)
+        for name, method in methods.items():
+            durations, replies = [], 0
+            for _ in range(args.runs):
+                started = time.perf_counter()
+                replies = method(targets)
+                durations.append(time.perf_counter() - started)
+
+            median_ms, min_ms = statistics.median(durations) * 1000, min(durations) * 1000
+            print(f"{count:>6} {name:<6} {median_ms:>8.2f}ms {min_ms:>8.2f}ms {replies:>4}/{count:<3}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,22 +5,40 @@ sudo crontab -e
 Add:
 # m h  dom mon dow   command
 00 *  *   *   *     /<REPO_ROOT>/.venv/bin/python /<REPO_ROOT>/rsync_backup.py
+
+Changes between backups are recorded by the `rsync_backup_watch` service, see `install.sh`.
 """
 
 import datetime
+import heapq
+import itertools
+import json
+import os
+import re
 import shutil
+import socket
+import statistics
 import subprocess
 import sys
-from functools import cache
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
 from ipaddress import IPv4Address
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Callable, Final, Iterable, Never
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from shared.cache import CACHE_DIR, invalidate_cache, load_cache, save_cache, write_atomically
+from shared.change_journal import ChangeJournal, Watcher
 from shared.constants import SEP
 from shared.metered_connection_status import is_internet_connection_metered
-from shared.notify import Notifier
+from shared.metrics import Metrics
+from shared.network_state import get_network_state
+from shared.notify import Notifier, NullNotifier
+from shared.rsync_excludes import analyze_excludes, exclude_rules
 
 
 class Settings(BaseSettings):
@@ -28,8 +46,28 @@ class Settings(BaseSettings):
     rsync_port: int
     rsync_servers: list[str]
     rsync_target_folder: str
-    rsync_log_file: Path = Path("/tmp/rsync_timeshift.log")
+    # Connects to `rsync --daemon` listening on `rsync_port` directly instead of running it over SSH
+    rsync_use_ssh: bool = True
+    rsync_notifications: bool = True
+    rsync_backup_interval_hours: float = 24
+    # Sends only the newest Timeshift snapshot, hard-linked on the server against the previous one
+    rsync_timeshift_snapshot_mode: bool = False
     rsync_min_upload_speed_in_mb: float = 5
+    rsync_max_workers: int = 2
+    rsync_probe_timeout_sec: float = 3
+    rsync_probe_cache_ttl_sec: int = 6 * 60 * 60
+    rsync_throughput_history_size: int = 20
+    rsync_throughput_history_max_age_days: float = 7
+    rsync_status_interval_sec: float = 1
+    # Values above 1 mirror the home folder as this many rsync runs over groups of its top-level entries
+    rsync_home_partitions: int = 1
+    rsync_partition_workers: int = 1
+    # Sources watched by `rsync_backup.py --watch`. Only changes recorded by the watcher are sent between full backups.
+    rsync_journal_sources: list[str] = ["/home/rlat"]
+    rsync_full_backup_interval_days: float = 7
+    # Point the textfile into the node exporter textfile collector folder to scrape it
+    rsync_metrics_textfile: Path | None = CACHE_DIR / "rsync_backup.prom"
+    rsync_metrics_jsonl_file: Path | None = CACHE_DIR / "rsync_backup_metrics.jsonl"
 
     model_config = SettingsConfigDict(
         env_file=Path(__file__).parent / ".env",
@@ -38,8 +76,131 @@ class Settings(BaseSettings):
     )
 
 
-settings = Settings()
-notifier = Notifier()
+@cache
+def get_settings() -> Settings:
+    return Settings()
+
+
+@cache
+def get_notifier() -> Notifier:
+    return Notifier() if get_settings().rsync_notifications else NullNotifier()
+
+
+@cache
+def get_metrics() -> Metrics:
+    return Metrics("rsync_backup")
+
+
+STATUS_FILE: Final[Path] = Path("/tmp/rsync_backup_status.json")
+# Progress older than this is left over from a killed run
+STATUS_MAX_AGE_SEC: Final[int] = 10 * 60
+
+# Vanished files logged into /var/log/auth.log
+HOME_EXCLUDES: Final[list[str]] = [
+    "SynologyDrive",
+    ".SynologyDrive",
+    "*/.git",
+    "*/.venv",
+    "*/__pycache__",
+    "*/.mypy_cache",
+    "*/.pytest_cache",
+    "*/.ruff_cache",
+    ".cache/JetBrains/*/python_stubs",
+    ".cache/JetBrains/*/cpython-cache",
+    ".cache/JetBrains/*/log",
+    ".cache/JetBrains/*/remote_sources",
+    ".cache/JetBrains/*/projects/*/gittoolbox/blame-store-xodus",
+    '.cache/JetBrains/Toolbox/backup',
+    ".cache/mozilla/firefox/*/cache2",
+    ".cache/pip",
+    ".cache/pypoetry",
+    ".cache/pre-commit",
+    ".cache/google-chrome",
+    ".cache/gnome-software/icons",
+    ".cache/mesa_shader_cache",
+    ".cache/thumbnails",
+    ".config/Lens/Cache",
+    ".config/Signal",
+    ".config/Franz",
+    ".config/google-chrome",
+    ".local/share/JetBrains/Toolbox",
+    ".local/share/Trash",
+    ".local/share/virtualenv",
+    ".local/lib",
+    ".pyenv",
+    ".npm",
+    ".nvm",
+    ".platformio",
+    ".var/app/*/cache",
+    ".var/app/*/config/*/Partitions/*/Service Worker/CacheStorage",
+    ".var/app/*/config/*/Service Worker/CacheStorage",
+    ".var/app/*/config/*/Cache",
+]
+
+SOURCE_EXCLUDES: Final[dict[str, list[str]]] = {"/home/rlat": HOME_EXCLUDES}
+
+SERVER_PROBE_CACHE_FILE = CACHE_DIR / "rsync_backup_servers.json"
+THROUGHPUT_HISTORY_FILE = CACHE_DIR / "rsync_backup_throughput.json"
+PARTITION_FILE_COUNTS_FILE = CACHE_DIR / "rsync_backup_file_counts.json"
+PARTITION_FILE_COUNTS_TTL_SEC = 24 * 60 * 60
+BACKUP_HISTORY_FILE = CACHE_DIR / "rsync_backup_history.json"
+JOURNAL_DIR = CACHE_DIR / "rsync_backup_journal"
+JOURNAL_FLUSH_INTERVAL_SEC = 5
+
+# Runs with almost nothing to send say little about the link
+MIN_THROUGHPUT_SAMPLE_BYTES = 100 * 10**6
+# Flags deciding what and how is mirrored. Output flags needed to follow the progress are added separately.
+RSYNC_FLAGS: Final[tuple[str, ...]] = (
+    "--inplace",
+    "--links",
+    "--hard-links",
+    "--archive",
+    "--no-inc-recursive",
+    "--delete",
+    "--delete-excluded",
+    "--prune-empty-dirs",
+)
+
+TIMESHIFT_SNAPSHOT_NAME: Final[re.Pattern] = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}")
+
+# Lines of `--stats` output recorded as transfer metrics
+STATS_METRICS: Final[dict[str, str]] = {
+    "Number of files": "files",
+    "Number of regular files transferred": "files_transferred",
+    "Total transferred file size": "transferred_bytes",
+    "Total bytes sent": "sent_bytes",
+    "File list generation time": "file_list_generation_seconds",
+    "File list transfer time": "file_list_transfer_seconds",
+}
+HUMAN_READABLE_UNITS = {"": 1, "K": 10**3, "k": 10**3, "M": 10**6, "G": 10**9, "T": 10**12}
+
+_throughput_lock = threading.Lock()
+_backup_history_lock = threading.Lock()
+
+
+class _RunningTransfers:
+    """Tracks transfers running at the same time, which share the link, so their rates are not rates of the link."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        # Ids of running transfers, mapped to whether another transfer ran during them
+        self._overlapped: dict[int, bool] = {}
+
+    def start(self) -> int:
+        with self._lock:
+            for transfer_id in self._overlapped:
+                self._overlapped[transfer_id] = True
+            self._overlapped[transfer_id := next(self._ids)] = bool(self._overlapped)
+        return transfer_id
+
+    def finish(self, transfer_id: int) -> bool:
+        """Returns whether the transfer shared the link with another one at any time."""
+        with self._lock:
+            return self._overlapped.pop(transfer_id)
+
+
+_running_transfers = _RunningTransfers()
 
 
 def run_command(command: list[str]) -> str:
@@ -49,145 +210,548 @@ def run_command(command: list[str]) -> str:
     return result.stdout
 
 
-def _format_number(number):
+def _format_number(number: float) -> str:
     for unit, divider, precision in [("G", 10**9, 1), ("M", 10**6, 1), ("k", 10**3, 1), ("", 1, 0)]:
-        if number > divider:
+        if number >= divider or not unit:
             return f"{number / divider:.{precision}f}{unit}"
 
 
-def _run_mirror_command(icon: str, source: str, exclude: Iterable[str] = ()) -> None:
+def _parse_human_readable(value: str) -> float:
+    """Converts rsync `--human-readable` values, such as '34.25M' or '5.19MB/s', to plain numbers."""
+    value = value.removesuffix("/s").removesuffix("B").replace(",", "")
+    if value and value[-1] in HUMAN_READABLE_UNITS:
+        return float(value[:-1]) * HUMAN_READABLE_UNITS[value[-1]]
+    return float(value)
+
+
+@cache
+def _active_network_name() -> str:
+    try:
+        active_connections = get_network_state().active_connections
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    for connection in active_connections:
+        if connection.type in ("802-11-wireless", "802-3-ethernet"):
+            return connection.name
+
+    return "unknown"
+
+
+def _throughput_history_key() -> str:
+    return f"{fastest_available_server()}@{_active_network_name()}"
+
+
+def _record_throughput(bits_per_sec: float) -> None:
+    with _throughput_lock:
+        history = load_cache(THROUGHPUT_HISTORY_FILE) or {}
+        samples = history.get(key := _throughput_history_key(), [])
+        samples.append([time.time(), bits_per_sec])
+        history[key] = samples[-get_settings().rsync_throughput_history_size :]
+        save_cache(THROUGHPUT_HISTORY_FILE, history)
+
+
+def _recent_throughput() -> float | None:
+    """Median of the fresh throughput samples for the current server and network, in bits/s."""
+    oldest = time.time() - get_settings().rsync_throughput_history_max_age_days * 86400
+    history = load_cache(THROUGHPUT_HISTORY_FILE) or {}
+    samples = history.get(_throughput_history_key(), [])
+    if fresh_samples := [bits_per_sec for timestamp, bits_per_sec in samples if timestamp >= oldest]:
+        return statistics.median(fresh_samples)
+    return None
+
+
+def _parse_duration(value: str) -> int:
+    seconds = 0
+    for part in value.split(":"):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def parse_progress_line(line: str) -> dict[str, Any] | None:
+    if line.endswith("files..."):
+        # Example: '1234 files...'
+        return {"files": int(line.split(" ", 1)[0])}
+
+    if "% " in line:
+        # Examples:
+        #   '34.25M   0%    5.19MB/s    0:00:06 (xfr#1186, to-chk=1168445/1170633)'
+        #   '34.25M   0%    5.19MB/s    0:00:06'
+        parts = line.split(maxsplit=4)
+        try:
+            progress = {
+                "bytes": int(_parse_human_readable(parts[0])),
+                "percent": int(parts[1].removesuffix("%")),
+                "rate": _parse_human_readable(parts[2]),
+                "eta": _parse_duration(parts[3]),
+            }
+
+            if len(parts) == 5:
+                xfr, to_chk = parts[4].strip("()").split(", ")
+                to_check, total = to_chk.removeprefix("to-chk=").removeprefix("ir-chk=").split("/")
+                progress |= {"xfr": int(xfr.removeprefix("xfr#")), "to_chk": int(to_check), "total": int(total)}
+        except (ValueError, IndexError):
+            return None
+
+        return progress
+
+    return None
+
+
+def parse_stats_line(line: str) -> tuple[str, float] | None:
+    # Examples:
+    #   'Number of files: 1,170,633 (reg: 1,040,311, dir: 127,502, link: 2,820)'
+    #   'Total transferred file size: 34.25M bytes'
+    #   'File list generation time: 0.001 seconds'
+    key, separator, value = line.partition(": ")
+    if separator and key in STATS_METRICS:
+        try:
+            return STATS_METRICS[key], _parse_human_readable(value.split(maxsplit=1)[0])
+        except ValueError:
+            return None
+    return None
+
+
+class ProgressWriter:
+    """Publishes progress of all running sources as JSON, at most once per `interval_sec`.
+
+    The file is replaced atomically, so `status()` never reads a partial write.
+    """
+
+    def __init__(self, path: Path, interval_sec: float):
+        self._path = path
+        self._interval_sec = interval_sec
+        self._sources: dict[str, dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._last_write = 0.0
+
+    def update(self, icon: str, progress: dict[str, Any]) -> None:
+        with self._lock:
+            self._sources[icon] = progress
+            if time.monotonic() - self._last_write >= self._interval_sec:
+                self._write()
+
+    def finish(self, icon: str) -> None:
+        with self._lock:
+            self._sources.pop(icon, None)
+            self._write()
+
+    def _write(self) -> None:
+        if self._sources:
+            write_atomically(self._path, json.dumps({"timestamp": time.time(), "sources": self._sources}))
+        else:
+            self._path.unlink(missing_ok=True)
+        self._last_write = time.monotonic()
+
+
+@cache
+def get_progress_writer() -> ProgressWriter:
+    return ProgressWriter(STATUS_FILE, get_settings().rsync_status_interval_sec)
+
+
+def _transport_args(settings: Settings) -> list[str]:
+    if settings.rsync_use_ssh:
+        return ["-e", f"ssh -l {settings.rsync_ssh_user} -p {settings.rsync_port}"]
+    return [f"--port={settings.rsync_port}"]
+
+
+def _run_mirror_command(
+    icon: str,
+    source: str,
+    exclude: Iterable[str] = (),
+    paths: Iterable[str] | None = None,
+    partition: str | None = None,
+    files_from: Path | None = None,
+    flags: Iterable[str] = RSYNC_FLAGS,
+    destination: str = "",
+) -> bool:
+    """Mirrors `source`, only its `paths` when a `partition` of it is mirrored or only paths listed in `files_from`.
+
+    The `destination` is a path in the target folder on the server to mirror into.
+    """
+    settings = get_settings()
+
+    if files_from is not None:
+        sources = ["--files-from", str(files_from), "--from0", "--recursive", "--delete-missing-args"]
+        sources.append(os.path.dirname(source))
+    elif paths is None:
+        sources = [source]
+    else:
+        parent, name = os.path.split(source)
+        # The '/./' marks where the path kept on the server starts, so partitions land where a full mirror would
+        sources = ["--relative", *(f"{parent}/./{name}/{path}" for path in paths)]
+
+    label = source if partition is None else f"{source} ({partition})"
+    progress_key = icon if partition is None else f"{icon}#{partition}"
+
     command = [
         "rsync",
-        "-e",
-        f"ssh -l {settings.rsync_ssh_user} -p {settings.rsync_port}",
+        *_transport_args(settings),
         "--info=name0,del0,progress2",
         "--progress",
-        "--inplace",
-        "--links",
-        "--hard-links",
-        "--archive",
         "--human-readable",
         "--verbose",
-        "--no-inc-recursive",
-        "--delete",
-        "--delete-excluded",
-        "--prune-empty-dirs",
-        *(f"--exclude='{_}'" for _ in exclude),
-        source,
-        f"{first_available_server()}::{settings.rsync_target_folder}",
+        "--stats",
+        *flags,
+        *(f"--exclude={_}" for _ in exclude),
+        *sources,
+        f"{fastest_available_server()}::{settings.rsync_target_folder}{destination}",
     ]
-    notifier.info(f"Backup started: {source}")
+    get_notifier().info(f"Backup started: {label}")
 
+    started = time.time()
+    started_perf = time.perf_counter()
+    transfer_id = _running_transfers.start()
     process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    stats: dict[str, float] = {}
+
+    progress_writer = get_progress_writer()
+
+    while process.poll() is None:
+        for line in iter(process.stdout.readline, ""):
+            if (stat := parse_stats_line(line.strip())) is not None:
+                stats[stat[0]] = stat[1]
+                continue
 
-    # While there is a process output, read the output line by line and write it to the log file
-    with open(settings.rsync_log_file, "a") as log:
-        while process.poll() is None:
-            for line in iter(process.stdout.readline, ""):
-                line = line.strip()
-                output = None
-
-                if line.endswith("files..."):
-                    # Example: '1234 files...'
-                    count = line.split(" ", 1)[0]
-                    output = _format_number(int(count))
-                elif "% " in line:
-                    # Examples:
-                    #   '34.25M   0%    5.19MB/s    0:00:06 (xfr#1186, to-chk=1168445/1170633)'
-                    #   '34.25M   0%    5.19MB/s    0:00:06'
-                    parts = line.split(maxsplit=4)
-                    output = f"{parts[0]} {parts[1]} {parts[2]} {parts[3]}"
-
-                if output is not None:
-                    log.seek(0)
-                    log.truncate()
-                    log.write(f"🔁{icon} {output}")
-                    log.flush()
+            if (progress := parse_progress_line(line.strip())) is None:
+                continue
+
+            progress_writer.update(progress_key, progress)
+
+    progress_writer.finish(progress_key)
+    duration_sec = time.perf_counter() - started_perf
+    overlapped = _running_transfers.finish(transfer_id)
+    _record_transfer_metrics(label, started, duration_sec, process.returncode, stats)
 
     if process.returncode != 0:
-        notifier.error(f"Backup failed: {source}", process.stderr.read())
-        return
+        # The cached server may be the reason of the failure, so the next run should probe again
+        invalidate_cache(SERVER_PROBE_CACHE_FILE)
+        get_notifier().error(f"Backup failed: {label}", process.stderr.read())
+        return False
+
+    # Sustained rate of bytes sent over the link. Progress rates count file bytes processed, which delta transfer and
+    # '--inplace' inflate far above that. A transfer sharing the link with others measures only its share of it.
+    transfer_sec = duration_sec - stats.get("file_list_generation_seconds", 0)
+    sent_bytes = stats.get("sent_bytes", 0)
+    if not overlapped and sent_bytes >= MIN_THROUGHPUT_SAMPLE_BYTES and transfer_sec > 0:
+        _record_throughput(sent_bytes * 8 / transfer_sec)
+
+    return True
+
+
+def _record_transfer_metrics(
+    label: str, started: float, duration_sec: float, exit_code: int, stats: dict[str, float]
+) -> None:
+    metrics = get_metrics()
+    metrics.add_span("transfer", started, duration_sec, source=label)
+    if (file_list_sec := stats.get("file_list_generation_seconds")) is not None:
+        metrics.add_span("file_list", started, file_list_sec, source=label)
+
+    metrics.set("transfer_duration_seconds", duration_sec, source=label)
+    metrics.set("transfer_exit_code", exit_code, source=label)
+    for name, value in stats.items():
+        metrics.set(f"transfer_{name}", value, source=label)
+    if (sent_bytes := stats.get("sent_bytes")) is not None and duration_sec > 0:
+        metrics.set("transfer_rate_bytes_per_second", sent_bytes / duration_sec, source=label)
+
+
+def _is_excluded(path: str, exclude: Iterable[str], is_dir: bool = True) -> bool:
+    """Whether rsync excludes `path`, given relative to the transfer root, e.g. 'rlat/.cache'."""
+    return exclude_rules(tuple(exclude)).match(path, is_dir) is not None
+
+
+def _count_files(path: str, relative_path: str, exclude: Iterable[str]) -> int:
+    """Counts entries below `path` without calling `stat`, so it is much cheaper than an rsync file list."""
+    count = 0
+    stack = [(path, relative_path)]
+
+    while stack:
+        path, relative_path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if _is_excluded(entry_relative_path := f"{relative_path}/{entry.name}", exclude, is_dir):
+                continue
+
+            count += 1
+            if is_dir:
+                stack.append((entry.path, entry_relative_path))
+
+    return count
+
+
+def _partition_source(source: str, exclude: Iterable[str], partitions: int) -> list[list[str]]:
+    """Splits top-level entries of `source` into up to `partitions` groups with a similar number of files."""
+    root = os.path.basename(source)
+    # Excluded trees are often the largest ones, so they are not even counted
+    entries = {
+        entry.name: entry
+        for entry in os.scandir(source)
+        if not _is_excluded(f"{root}/{entry.name}", exclude, entry.is_dir(follow_symlinks=False))
+    }
+    cached = load_cache(PARTITION_FILE_COUNTS_FILE, PARTITION_FILE_COUNTS_TTL_SEC) or {}
+    if (file_counts := cached.get(source)) is None or set(file_counts) != set(entries):
+        file_counts = {}
+        for name, entry in entries.items():
+            is_dir = entry.is_dir(follow_symlinks=False)
+            file_counts[name] = 1 + (_count_files(entry.path, f"{root}/{name}", exclude) if is_dir else 0)
+        save_cache(PARTITION_FILE_COUNTS_FILE, cached | {source: file_counts})
+
+    # Greedily places the largest remaining entry into the smallest group
+    groups: list[tuple[int, int, list[str]]] = [(0, index, []) for index in range(partitions)]
+    for name in sorted(file_counts, key=file_counts.get, reverse=True):
+        count, index, names = heapq.heappop(groups)
+        names.append(name)
+        heapq.heappush(groups, (count + file_counts[name], index, names))
 
-    return
-
-
-def mirror_timeshift() -> None:
-    _run_mirror_command("⏳️", "/timeshift")
-
-
-def mirror_home() -> None:
-    # Vanished files logged into /var/log/auth.log
-    excludes = [
-        "SynologyDrive",
-        ".SynologyDrive",
-        "*/.git",
-        "*/.venv",
-        "*/__pycache__",
-        "*/.mypy_cache",
-        "*/.pytest_cache",
-        "*/.ruff_cache",
-        ".cache/JetBrains/*/python_stubs",
-        ".cache/JetBrains/*/cpython-cache",
-        ".cache/JetBrains/*/log",
-        ".cache/JetBrains/*/remote_sources",
-        ".cache/JetBrains/*/projects/*/gittoolbox/blame-store-xodus",
-        '.cache/JetBrains/Toolbox/backup',
-        ".cache/mozilla/firefox/*/cache2",
-        ".cache/pip",
-        ".cache/pypoetry",
-        ".cache/pre-commit",
-        ".cache/google-chrome",
-        ".cache/gnome-software/icons",
-        ".cache/mesa_shader_cache",
-        ".cache/thumbnails",
-        ".config/Lens/Cache"
-        ".config/Signal",
-        ".config/Franz",
-        ".config/google-chrome",
-        ".local/share/JetBrains/Toolbox",
-        ".local/share/Trash",
-        ".local/share/virtualenv",
-        ".local/lib",
-        ".pyenv",
-        ".npm",
-        ".nvm",
-        ".platformio",
-        ".var/app/*/cache",
-        ".var/app/*/config/*/Partitions/*/Service Worker/CacheStorage",
-        ".var/app/*/config/*/Service Worker/CacheStorage",
-        ".var/app/*/config/*/Cache",
+    return [names for _, _, names in sorted(groups, key=lambda group: group[1]) if names]
+
+
+def _backup_history(source: str) -> dict[str, Any]:
+    return (load_cache(BACKUP_HISTORY_FILE) or {}).get(source, {})
+
+
+def _update_backup_history(source: str, **fields: Any) -> None:
+    with _backup_history_lock:
+        backups = load_cache(BACKUP_HISTORY_FILE) or {}
+        save_cache(BACKUP_HISTORY_FILE, backups | {source: backups.get(source, {}) | fields})
+
+
+def _is_due(source: str) -> bool:
+    completed = _backup_history(source).get("completed", 0)
+    return time.time() - completed >= get_settings().rsync_backup_interval_hours * 3600
+
+
+def _resumed_partitions(source: str) -> tuple[float, set[str]] | None:
+    """Start of an interrupted partitioned backup of `source` and its top-level entries already mirrored."""
+    last_backup = _backup_history(source)
+    if not (done := last_backup.get("partitions_done")):
+        return None
+
+    if time.time() - last_backup["partitions_started"] >= get_settings().rsync_backup_interval_hours * 3600:
+        return None
+
+    return last_backup["partitions_started"], set(done)
+
+
+def _run_partitioned_mirror_command(
+    icon: str, source: str, exclude: Iterable[str], partitions: int, started: float, done: set[str]
+) -> bool:
+    """Mirrors `source` in partitions, except for top-level entries a run started at `started` has already `done`."""
+    done_lock = threading.Lock()
+    groups = [
+        remaining
+        for group in _partition_source(source, exclude, partitions)
+        if (remaining := [name for name in group if name not in done])
     ]
-    _run_mirror_command("🏡", "/home/rlat", excludes)
 
-@cache
-def first_available_server() -> str | None:
-    if not shutil.which("nping"):
-        notifier.critical("Skipping backup: nmap is not installed.", "Run 'sudo apt install nmap'.")
+    def mirror_group(paths: list[str], partition: str) -> bool:
+        if success := _run_mirror_command(icon, source, exclude, paths, partition):
+            with done_lock:
+                done.update(paths)
+                _update_backup_history(source, partitions_started=started, partitions_done=sorted(done))
+        return success
+
+    with ThreadPoolExecutor(max_workers=max(get_settings().rsync_partition_workers, 1)) as executor:
+        futures = [
+            executor.submit(mirror_group, paths, f"{index}/{len(groups)}")
+            for index, paths in enumerate(groups, start=1)
+        ]
+        return all([future.result() for future in futures])
+
+
+def _journal(source: str) -> ChangeJournal:
+    return ChangeJournal(JOURNAL_DIR / source.strip("/").replace("/", "_"))
+
+
+def _is_excluded_from_backup(path: str) -> bool:
+    return any(
+        path.startswith(f"{source}/") and _is_excluded(os.path.relpath(path, os.path.dirname(source)), exclude)
+        for source, exclude in SOURCE_EXCLUDES.items()
+    )
+
+
+def _take_journal_changes(source: str, last_backup: dict[str, Any]) -> set[tuple[str, str]] | None:
+    """Changes recorded since the last backup of `source` or `None` when a full backup is needed."""
+    settings = get_settings()
+    if source not in settings.rsync_journal_sources or "completed" not in last_backup:
         return None
 
-    for server in settings.rsync_servers:
-        if "Successful connections: 1" in run_command(
-            ["nping", "--tcp-connect", "-c", "1", "-p", str(settings.rsync_port), "-q", server]
-        ):
-            return server
+    if time.time() - last_backup["full"] > settings.rsync_full_backup_interval_days * 86400:
+        return None
 
-    return None
+    if not (journal := _journal(source)).is_complete_since(last_backup["started"]):
+        return None
 
-def fast_upload(min_upload_speed_in_mb: float) -> bool:
-    if not shutil.which("speedtest"):
-        notifier.critical("Skipping backup: speedtest is not installed.", "Run 'sudo apt install speedtest-cli'.")
+    return journal.take()
+
+
+def _run_incremental_mirror_command(
+    icon: str, source: str, exclude: Iterable[str], changes: set[tuple[str, str]]
+) -> bool:
+    if not changes:
+        return True
+
+    parent = os.path.dirname(source)
+    with tempfile.NamedTemporaryFile("w", prefix="rsync_backup_files_from_") as files_from:
+        # New folders (trees) are sent recursively, other paths on their own or deleted on the server when missing
+        files_from.write("".join(f"{os.path.relpath(path, parent)}\0" for _kind, path in sorted(changes)))
+        files_from.flush()
+        return _run_mirror_command(icon, source, exclude, files_from=Path(files_from.name))
+
+
+def _mirror(icon: str, source: str, exclude: Iterable[str] = (), partitions: int = 1) -> bool:
+    started = time.time()
+    last_backup = _backup_history(source)
+    resumed = None
+
+    if (changes := _take_journal_changes(source, last_backup)) is not None:
+        success = _run_incremental_mirror_command(icon, source, exclude, changes)
+        full = last_backup["full"]
+    else:
+        if source in get_settings().rsync_journal_sources:
+            # A full backup covers everything recorded so far
+            _journal(source).take()
+
+        if partitions > 1:
+            resumed = _resumed_partitions(source)
+            cycle_started, done = resumed or (started, set())
+            success = _run_partitioned_mirror_command(icon, source, exclude, partitions, cycle_started, done)
+        else:
+            success = _run_mirror_command(icon, source, exclude)
+        full = started
+
+    if not success:
         return False
 
+    # Partitions mirrored by an interrupted run may have changed since, the next incremental run sends them
+    if resumed is not None:
+        started = full = resumed[0]
+    elif source in get_settings().rsync_journal_sources:
+        _journal(source).acknowledge()
+
+    _update_backup_history(source, started=started, full=full, completed=time.time(), partitions_done=[])
+
+    return True
+
+
+def _remote_snapshots(destination: str) -> list[str]:
+    settings = get_settings()
+    remote = f"{fastest_available_server()}::{settings.rsync_target_folder}{destination}"
     try:
-        upload_speed_in_bytes = float(
-            run_command(["speedtest", "--no-download", "--secure", "--single", "--csv"]).split(",")[7]
-        )
+        stdout = run_command(["rsync", *_transport_args(settings), "--list-only", remote])
     except subprocess.CalledProcessError:
-        notifier.error("Skipping backup: Speed test failed.")
+        # Nothing has been mirrored yet
+        return []
+
+    # Example: 'drwxr-xr-x          4,096 2024/01/01 10:00:00 2024-01-01_10-00-01'
+    names = (line.rsplit(maxsplit=1)[-1] for line in stdout.splitlines() if line.strip())
+    return sorted(name for name in names if TIMESHIFT_SNAPSHOT_NAME.fullmatch(name))
+
+
+def _mirror_timeshift_snapshot(icon: str, source: str) -> bool:
+    """Mirrors only the newest snapshot, so rsync tracks the hard links of one snapshot instead of all of them.
+
+    Unchanged files are hard-linked on the server to the previous mirrored snapshot with `--link-dest`.
+    """
+    snapshots = sorted(name for name in os.listdir(f"{source}/snapshots") if TIMESHIFT_SNAPSHOT_NAME.fullmatch(name))
+    if not snapshots or _backup_history(source).get("snapshot") == (newest := snapshots[-1]):
+        _update_backup_history(source, completed=time.time())
+        return True
+
+    destination = f"/{os.path.basename(source)}/snapshots"
+    # The snapshots folder does not exist on the server before the first mirror and rsync creates only the last level
+    flags = [*RSYNC_FLAGS, "--mkpath"]
+    if (base := max((_ for _ in _remote_snapshots(f"{destination}/") if _ < newest), default=None)) is not None:
+        # Relative to the destination folder of the new snapshot
+        flags.append(f"--link-dest=../{base}")
+
+    snapshot = f"{source}/snapshots/{newest}/"
+    if not _run_mirror_command(icon, snapshot, flags=flags, destination=f"{destination}/{newest}/"):
         return False
 
-    if (upload_speed_in_mb := upload_speed_in_bytes / 1024**2) < min_upload_speed_in_mb:
-        notifier.network_error(
+    settings = get_settings()
+    remote = f"{fastest_available_server()}::{settings.rsync_target_folder}"
+    try:
+        # Removes snapshots deleted by Timeshift without descending into the kept ones. Without '--existing', it would
+        # create empty folders for snapshots taken since the last run, which look like mirrored snapshots.
+        run_command(
+            ["rsync", *_transport_args(settings), "--dirs", "--links", "--times", "--perms", "--delete", "--existing"]
+            + [f"{source}/snapshots/", f"{remote}{destination}/"]
+        )
+        # The 'snapshots-hourly' and similar folders only hold symlinks to the snapshots
+        run_command(
+            ["rsync", *_transport_args(settings), "--archive", "--delete", "--exclude=/snapshots/"]
+            + [f"{source}/", f"{remote}/{os.path.basename(source)}/"]
+        )
+    except subprocess.CalledProcessError as exc:
+        get_notifier().error(f"Backup failed: {source} snapshot list", exc.stderr)
+        return False
+
+    _update_backup_history(source, snapshot=newest, completed=time.time())
+    return True
+
+
+def mirror_timeshift() -> bool:
+    if get_settings().rsync_timeshift_snapshot_mode:
+        return _mirror_timeshift_snapshot("⏳️", "/timeshift")
+    return _mirror("⏳️", "/timeshift")
+
+
+def mirror_home() -> bool:
+    return _mirror("🏡", "/home/rlat", HOME_EXCLUDES, get_settings().rsync_home_partitions)
+
+
+MIRRORS: Final[dict[str, Callable[[], bool]]] = {"/home/rlat": mirror_home, "/timeshift": mirror_timeshift}
+
+
+def watch() -> Never:
+    journals = {source: _journal(source) for source in get_settings().rsync_journal_sources}
+    Watcher(journals, _is_excluded_from_backup, JOURNAL_FLUSH_INTERVAL_SEC).run()
+
+
+def _probe_server(server: str, port: int, timeout_sec: float) -> float | None:
+    """Returns the TCP connect round-trip time in seconds or `None` if the server doesn't answer."""
+    started = time.perf_counter()
+    try:
+        with socket.create_connection((server, port), timeout=timeout_sec):
+            return time.perf_counter() - started
+    except OSError:
+        return None
+
+
+@cache
+def fastest_available_server() -> str | None:
+    settings = get_settings()
+    cached = load_cache(SERVER_PROBE_CACHE_FILE, settings.rsync_probe_cache_ttl_sec)
+    if cached is not None and cached["servers"] == settings.rsync_servers:
+        return cached["server"]
+
+    probe = partial(_probe_server, port=settings.rsync_port, timeout_sec=settings.rsync_probe_timeout_sec)
+    with ThreadPoolExecutor(max_workers=max(len(settings.rsync_servers), 1)) as executor:
+        rtts = dict(zip(settings.rsync_servers, executor.map(probe, settings.rsync_servers)))
+
+    if (server := min((_ for _ in rtts if rtts[_] is not None), key=rtts.get, default=None)) is not None:
+        save_cache(SERVER_PROBE_CACHE_FILE, {"server": server, "servers": settings.rsync_servers, "rtts": rtts})
+
+    return server
+
+
+def fast_upload(min_upload_speed_in_mb: float) -> bool:
+    upload_speed_in_bits = _recent_throughput()
+    # A skipped backup records no sample, so a slow history is measured again instead of blocking backups until it
+    # ages out
+    if upload_speed_in_bits is None or upload_speed_in_bits / 1024**2 < min_upload_speed_in_mb:
+        if (upload_speed_in_bits := speedtest_upload()) is None:
+            return False
+        _record_throughput(upload_speed_in_bits)
+
+    if (upload_speed_in_mb := upload_speed_in_bits / 1024**2) < min_upload_speed_in_mb:
+        get_notifier().network_error(
             f"Skipping backup: Upload speed is {upload_speed_in_mb:.2f} Mb. Required minimum is {min_upload_speed_in_mb} Mb."
         )
         return False
@@ -195,14 +759,41 @@ def fast_upload(min_upload_speed_in_mb: float) -> bool:
     return True
 
 
+def speedtest_upload() -> float | None:
+    if not shutil.which("speedtest"):
+        get_notifier().critical("Skipping backup: speedtest is not installed.", "Run 'sudo apt install speedtest-cli'.")
+        return None
+
+    try:
+        with get_metrics().span("speedtest"):
+            stdout = run_command(["speedtest", "--no-download", "--secure", "--single", "--csv"])
+        # Upload speed is reported in bits/s
+        return float(stdout.split(",")[7])
+    except subprocess.CalledProcessError:
+        get_notifier().error("Skipping backup: Speed test failed.")
+        return None
+
+
 def main() -> None:
-    log_file = settings.rsync_log_file
-    if log_file.exists() and log_file.stat().st_mtime >= datetime.datetime.now().timestamp() - 86400:
+    settings = get_settings()
+    if not (due := [mirror for source, mirror in MIRRORS.items() if _is_due(source)]):
         print("Backup has been executed today already. Skipping.")
         return
 
-    if (server := first_available_server()) is None:
-        notifier.network_error("Skipping backup: No backup server available")
+    try:
+        _backup(settings, due)
+    finally:
+        get_metrics().export(settings.rsync_metrics_textfile, settings.rsync_metrics_jsonl_file)
+
+
+def _backup(settings: Settings, mirrors: list[Callable[[], bool]]) -> None:
+    metrics = get_metrics()
+
+    with metrics.span("server_probe"):
+        server = fastest_available_server()
+
+    if server is None:
+        get_notifier().network_error("Skipping backup: No backup server available")
         return
 
     try:
@@ -211,26 +802,89 @@ def main() -> None:
         server_on_private_network = False
 
     if not server_on_private_network:
-        if is_internet_connection_metered():
-            notifier.network_error("Skipping backup: On a metered connection")
-            return
+        with metrics.span("metered_check"):
+            metered = is_internet_connection_metered()
 
-        if not fast_upload(settings.rsync_min_upload_speed_in_mb):
+        if metered:
+            get_notifier().network_error("Skipping backup: On a metered connection")
             return
 
-    mirror_home()
-    mirror_timeshift()
-    log_file.write_text("")
+        with metrics.span("upload_check"):
+            if not fast_upload(settings.rsync_min_upload_speed_in_mb):
+                return
+
+    with ThreadPoolExecutor(max_workers=max(settings.rsync_max_workers, 1)) as executor:
+        for future in [executor.submit(mirror) for mirror in mirrors]:
+            future.result()
+
+
+def print_exclude_analysis(source: str = "/home/rlat", candidates_limit: int = 20) -> None:
+    report = analyze_excludes(source, SOURCE_EXCLUDES[source])
+
+    print(f"{'Pattern':<64} {'Files':>8} {'Bytes':>8}")
+    for pattern, stats in sorted(report.pruned.items(), key=lambda item: item[1].bytes, reverse=True):
+        print(f"{pattern:<64} {_format_number(stats.files):>8} {_format_number(stats.bytes):>8}")
+
+    print(f"\n{'Sent':<64} {_format_number(report.included.files):>8} {_format_number(report.included.bytes):>8}")
+
+    print(f"\n{'Largest cache-like folders still sent':<64} {'Files':>8} {'Bytes':>8}")
+    candidates = sorted(report.candidates.items(), key=lambda item: item[1].bytes, reverse=True)
+    for path, stats in candidates[:candidates_limit]:
+        print(f"{path:<64} {_format_number(stats.files):>8} {_format_number(stats.bytes):>8}")
+
+
+def _aggregate_partitions(sources: dict[str, dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    """Merges progress of partitions (keys such as '🏡#2/4') into one progress per source icon."""
+    partitions_by_icon: dict[str, list[dict[str, Any]]] = {}
+    for key, progress in sources.items():
+        partitions_by_icon.setdefault(key.split("#", 1)[0], []).append(progress)
+
+    aggregated = {}
+    for icon, partitions in partitions_by_icon.items():
+        if not (transferring := [_ for _ in partitions if "files" not in _]):
+            aggregated[icon] = {"files": sum(_["files"] for _ in partitions)}
+            continue
+
+        aggregated[icon] = {
+            "bytes": sum(_["bytes"] for _ in transferring),
+            "percent": sum(_["percent"] for _ in transferring) // len(transferring),
+            "rate": sum(_["rate"] for _ in transferring),
+            "eta": max(_["eta"] for _ in transferring),
+        }
+
+    return aggregated
 
 
 def status() -> None:
-    if settings.rsync_log_file.exists():
-        if (log := settings.rsync_log_file.read_text()) != "":
-            print(f"{log}{SEP}", end="")
+    try:
+        progress = json.loads(STATUS_FILE.read_text())
+    except (OSError, ValueError):
+        return
+
+    if time.time() - progress["timestamp"] > STATUS_MAX_AGE_SEC:
+        return
+
+    outputs = []
+    for icon, source in _aggregate_partitions(progress["sources"]).items():
+        if "files" in source:
+            output = _format_number(source["files"])
+        else:
+            output = (
+                f"{_format_number(source['bytes'])} {source['percent']}% "
+                f"{_format_number(source['rate'])}B/s {datetime.timedelta(seconds=source['eta'])}"
+            )
+        outputs.append(f"🔁{icon} {output}")
+
+    if outputs:
+        print(f"{' '.join(outputs)}{SEP}", end="")
 
 
 if __name__ == "__main__":
     if sys.argv[-1] == "--status":
         status()
+    elif sys.argv[-1] == "--watch":
+        watch()
+    elif sys.argv[-1] == "--analyze-excludes":
+        print_exclude_analysis()
     else:
         main()
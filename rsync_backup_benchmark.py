@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Measures how rsync flag choices of `rsync_backup.py` affect file-list time, peak memory and throughput.
+
+Synthetic trees are mirrored into a local `rsync --daemon` through the real `_run_mirror_command`. Each tree and
+flag profile is mirrored twice: an initial run into an empty target and a run without changes, which is what most
+hourly backups look like.
+
+To run:
+
+python rsync_backup_benchmark.py --files 10000 100000 --depth 4 --hard-link-ratio 0.2 --sizes mixed
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Final, Iterator
+
+import rsync_backup
+
+# Parameters of a log-normal distribution of file sizes in bytes
+SIZE_DISTRIBUTIONS: Final[dict[str, tuple[float, float]]] = {
+    "small": (7.0, 1.0),
+    "mixed": (9.0, 2.5),
+    "large": (14.0, 1.5),
+}
+MAX_FILE_SIZE: Final[int] = 64 * 1024**2
+FOLDERS_PER_LEVEL: Final[int] = 8
+
+PROFILES: Final[dict[str, tuple[str, ...]]] = {
+    "current": rsync_backup.RSYNC_FLAGS,
+    "inc-recursive": tuple(_ for _ in rsync_backup.RSYNC_FLAGS if _ != "--no-inc-recursive"),
+    "no-hard-links": tuple(_ for _ in rsync_backup.RSYNC_FLAGS if _ != "--hard-links"),
+    "no-inplace": tuple(_ for _ in rsync_backup.RSYNC_FLAGS if _ != "--inplace"),
+    "keep-empty-dirs": tuple(_ for _ in rsync_backup.RSYNC_FLAGS if _ != "--prune-empty-dirs"),
+}
+
+
+@dataclass(frozen=True)
+class TreeSpec:
+    files: int
+    depth: int
+    hard_link_ratio: float
+    sizes: str
+
+    def __str__(self) -> str:
+        return f"{self.files} files, depth {self.depth}, {self.hard_link_ratio:.0%} links, {self.sizes}"
+
+
+def generate_tree(root: Path, spec: TreeSpec, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    mu, sigma = SIZE_DISTRIBUTIONS[spec.sizes]
+    originals: list[Path] = []
+
+    for index in range(spec.files):
+        folder = root.joinpath(*(f"d{rng.randrange(FOLDERS_PER_LEVEL)}" for _ in range(rng.randint(0, spec.depth))))
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"f{index}"
+
+        if originals and rng.random() < spec.hard_link_ratio:
+            os.link(rng.choice(originals), path)
+        else:
+            path.write_bytes(rng.randbytes(min(int(rng.lognormvariate(mu, sigma)), MAX_FILE_SIZE)))
+            originals.append(path)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def rsync_daemon(root: Path, port: int) -> Iterator[None]:
+    (target := root / "target").mkdir()
+    config = root / "rsyncd.conf"
+    config.write_text(f"use chroot = false\n[bench]\npath = {target}\nread only = false\n")
+    process = subprocess.Popen(
+        ["rsync", "--daemon", "--no-detach", "--address=127.0.0.1", f"--port={port}", f"--config={config}"]
+    )
+
+    try:
+        deadline = time.monotonic() + 10
+        while rsync_backup._probe_server("127.0.0.1", port, timeout_sec=1) is None:
+            if time.monotonic() > deadline or process.poll() is not None:
+                raise RuntimeError("rsync daemon did not start.")
+            time.sleep(0.1)
+        yield
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _mirror(target_folder: str, source: str, flags: tuple[str, ...]) -> dict[str, float]:
+    """Runs in a fresh process, so the peak memory of finished child processes belongs to this run only."""
+    os.environ["RSYNC_TARGET_FOLDER"] = target_folder
+    # The status file is not below the cache folder and would otherwise clobber the progress of a real backup
+    rsync_backup.STATUS_FILE = Path(os.environ["XDG_CACHE_HOME"]) / rsync_backup.STATUS_FILE.name
+
+    started = time.perf_counter()
+    success = rsync_backup._run_mirror_command("🧪", source, flags=flags)
+    duration_sec = time.perf_counter() - started
+
+    gauges = {_["name"]: _["value"] for _ in json.loads(rsync_backup.get_metrics().to_json())["gauges"]}
+    return {
+        "success": success,
+        "duration_sec": duration_sec,
+        "file_list_sec": gauges.get("transfer_file_list_generation_seconds", 0.0),
+        "rate": gauges.get("transfer_rate_bytes_per_second", 0.0),
+        # Kilobytes on Linux
+        "max_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+
+
+def run_benchmark(specs: list[TreeSpec], profiles: list[str]) -> None:
+    with tempfile.TemporaryDirectory(prefix="rsync_backup_benchmark_") as workdir:
+        root = Path(workdir)
+        port = _free_port()
+        # Inherited by the worker processes, so caches and history of real backups stay untouched
+        os.environ |= {
+            "RSYNC_SSH_USER": "benchmark",
+            "RSYNC_PORT": str(port),
+            "RSYNC_SERVERS": '["127.0.0.1"]',
+            "RSYNC_USE_SSH": "false",
+            "RSYNC_NOTIFICATIONS": "false",
+            "XDG_CACHE_HOME": str(root / "cache"),
+        }
+
+        print(f"{'Tree':<45} {'Profile':<16} {'Run':<8} {'Total':>8} {'List':>8} {'RSS':>8} {'Rate':>10}")
+        with rsync_daemon(root, port), ProcessPoolExecutor(
+            max_workers=1, mp_context=get_context("spawn"), max_tasks_per_child=1
+        ) as executor:
+            for tree_index, spec in enumerate(specs):
+                generate_tree(source := root / f"tree{tree_index}", spec)
+
+                for profile in profiles:
+                    target_folder = f"bench/tree{tree_index}-{profile}"
+                    for run in ("initial", "no-op"):
+                        result = executor.submit(_mirror, target_folder, str(source), PROFILES[profile]).result()
+                        print(
+                            f"{str(spec):<45} {profile:<16} {run:<8} "
+                            f"{result['duration_sec']:>7.2f}s {result['file_list_sec']:>7.2f}s "
+                            f"{rsync_backup._format_number(result['max_rss_bytes']):>7}B "
+                            f"{rsync_backup._format_number(result['rate']):>7}B/s"
+                            f"{'' if result['success'] else ' FAILED'}"
+                        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--hard-link-ratio", type=float, default=0.1)
+    parser.add_argument("--sizes", choices=SIZE_DISTRIBUTIONS, default="small")
+    parser.add_argument("--profiles", choices=PROFILES, nargs="+", default=list(PROFILES))
+    args = parser.parse_args()
+
+    specs = [TreeSpec(files, args.depth, args.hard_link_ratio, args.sizes) for files in args.files]
+    run_benchmark(specs, args.profiles)
+
+
+if __name__ == "__main__":
+    main()
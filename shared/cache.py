@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Final
+
+CACHE_DIR: Final[Path] = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "utility-scripts"
+# State of the machine written only by root, e.g. by the backup run from its cron, and readable by all users
+SHARED_CACHE_DIR: Final[Path] = Path("/run/utility-scripts")
+
+
+def write_atomically(path: Path, text: str) -> None:
+    """Readers never see a partially written file, only the old or the new content."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def make_shared_cache_dir() -> None:
+    """Creates `SHARED_CACHE_DIR`, which only root can create in `/run` and write to."""
+    SHARED_CACHE_DIR.mkdir(mode=0o755, exist_ok=True)
+    os.chmod(SHARED_CACHE_DIR, 0o755)
+
+
+def load_cache(path: Path, ttl_sec: float | None = None) -> Any | None:
+    try:
+        cached = json.loads(path.read_text())
+        if ttl_sec is not None and time.time() - cached["timestamp"] > ttl_sec:
+            return None
+        return cached["data"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(path: Path, data: Any) -> None:
+    write_atomically(path, json.dumps({"timestamp": time.time(), "data": data}))
+
+
+def invalidate_cache(path: Path) -> None:
+    path.unlink(missing_ok=True)
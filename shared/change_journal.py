@@ -0,0 +1,221 @@
+"""Journal of paths changed below watched folders, recorded with inotify between backups.
+
+A backup that can trust the journal sends only the changed paths instead of letting rsync stat the whole tree.
+"""
+import ctypes
+import fcntl
+import json
+import os
+import select
+import struct
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Final, Iterable, Iterator, Never
+
+from shared.cache import write_atomically
+
+IN_MODIFY: Final[int] = 0x00000002
+IN_ATTRIB: Final[int] = 0x00000004
+IN_MOVED_FROM: Final[int] = 0x00000040
+IN_MOVED_TO: Final[int] = 0x00000080
+IN_CREATE: Final[int] = 0x00000100
+IN_DELETE: Final[int] = 0x00000200
+IN_Q_OVERFLOW: Final[int] = 0x00004000
+IN_IGNORED: Final[int] = 0x00008000
+IN_ONLYDIR: Final[int] = 0x01000000
+IN_DONT_FOLLOW: Final[int] = 0x02000000
+IN_EXCL_UNLINK: Final[int] = 0x04000000
+IN_ISDIR: Final[int] = 0x40000000
+
+WATCH_MASK: Final[int] = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+_EVENT: Final[struct.Struct] = struct.Struct("iIII")
+
+# Journal entry kinds. A tree is a new folder whose whole content must be sent, a path is sent on its own.
+TREE: Final[str] = "T"
+PATH: Final[str] = "P"
+
+# A watcher whose heartbeat is older than this is considered dead
+HEARTBEAT_MAX_AGE_SEC: Final[int] = 5 * 60
+
+
+class ChangeJournal:
+    def __init__(self, directory: Path):
+        self._directory = directory
+        self._changes_file = directory / "changes.log"
+        self._taken_file = directory / "changes.taken"
+        self._watcher_file = directory / "watcher.json"
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        with open(self._directory / ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def append(self, entries: Iterable[tuple[str, str]]) -> None:
+        with self._locked(), open(self._changes_file, "a") as changes:
+            changes.writelines(f"{kind} {path}\n" for kind, path in entries)
+
+    def take(self) -> set[tuple[str, str]]:
+        """Returns all recorded entries, including those taken by a run that did not `acknowledge` them.
+
+        Taken entries are kept on disk until acknowledged, so a failed or killed backup cannot lose them.
+        """
+        with self._locked():
+            lines = []
+            for path in (self._taken_file, self._changes_file):
+                try:
+                    lines.extend(path.read_text().splitlines())
+                except FileNotFoundError:
+                    pass
+
+            entries = {(line[0], line[2:]) for line in lines if line}
+            write_atomically(self._taken_file, "".join(f"{kind} {path}\n" for kind, path in entries))
+            self._changes_file.unlink(missing_ok=True)
+
+        return entries
+
+    def acknowledge(self) -> None:
+        """Forgets entries returned by the last `take`, once they have been backed up."""
+        with self._locked():
+            self._taken_file.unlink(missing_ok=True)
+
+    def write_watcher_state(self, started: float, overflowed: float | None) -> None:
+        state = {"pid": os.getpid(), "started": started, "heartbeat": time.time(), "overflowed": overflowed}
+        write_atomically(self._watcher_file, json.dumps(state))
+
+    def is_complete_since(self, timestamp: float) -> bool:
+        """Whether a live watcher has recorded every change since `timestamp` without losing events."""
+        try:
+            state = json.loads(self._watcher_file.read_text())
+        except (OSError, ValueError):
+            return False
+
+        return (
+            time.time() - state["heartbeat"] <= HEARTBEAT_MAX_AGE_SEC
+            and state["started"] <= timestamp
+            and (state["overflowed"] is None or state["overflowed"] < timestamp)
+        )
+
+
+class _Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        if (fd := self._libc.inotify_init1(os.O_CLOEXEC)) < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.fd = fd
+
+    def add_watch(self, path: str) -> int:
+        if (wd := self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)) < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    def read_events(self) -> Iterator[tuple[int, int, str]]:
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, name
+
+
+class Watcher:
+    """Watches folders with inotify and records changed paths into their journals.
+
+    Folders for which `exclude(path)` is true are neither watched nor recorded.
+    """
+
+    def __init__(self, journals: dict[str, ChangeJournal], exclude: Callable[[str], bool], flush_interval_sec: float):
+        self._journals = journals
+        self._exclude = exclude
+        self._flush_interval_sec = flush_interval_sec
+        self._inotify = _Inotify()
+        self._watches: dict[int, tuple[str, str]] = {}
+        self._pending: dict[str, set[tuple[str, str]]] = {root: set() for root in journals}
+        self._overflowed: dict[str, float | None] = {root: None for root in journals}
+        # Roots with folders left unwatched, whose journals stay incomplete for as long as this watcher runs
+        self._degraded: set[str] = set()
+        # Set once all folders are watched. Changes made before then, in folders not watched yet, may be missing.
+        self._started: float | None = None
+
+    def _watch_tree(self, root: str, path: str) -> None:
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            try:
+                self._watches[self._inotify.add_watch(path)] = (root, path)
+                entries = list(os.scandir(path))
+            except (FileNotFoundError, NotADirectoryError):
+                # The folder vanished while being watched, changes in it may have been missed
+                self._overflowed[root] = time.time()
+                continue
+            except OSError:
+                # Out of watches (see fs.inotify.max_user_watches), changes in the folder will be missed
+                self._degraded.add(root)
+                continue
+
+            stack.extend(
+                entry.path for entry in entries if entry.is_dir(follow_symlinks=False) and not self._exclude(entry.path)
+            )
+
+    def _handle_event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            for root in self._overflowed:
+                self._overflowed[root] = time.time()
+            return
+
+        if mask & IN_IGNORED:
+            self._watches.pop(wd, None)
+            return
+
+        if (watch := self._watches.get(wd)) is None or not name:
+            return
+
+        root, folder = watch
+        if self._exclude(path := os.path.join(folder, name)):
+            return
+
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(root, path)
+            self._pending[root].add((TREE, path))
+        elif not mask & IN_ISDIR or mask & (IN_DELETE | IN_MOVED_FROM):
+            self._pending[root].add((PATH, path))
+
+    def _flush(self) -> None:
+        for root, journal in self._journals.items():
+            if self._pending[root]:
+                journal.append(self._pending[root])
+                self._pending[root] = set()
+            if root in self._degraded:
+                # Stamped again on every flush, so no backup started meanwhile can trust the journal
+                self._overflowed[root] = time.time()
+            journal.write_watcher_state(self._started, self._overflowed[root])
+
+    def run(self) -> Never:
+        for root in self._journals:
+            self._watch_tree(root, root)
+        self._started = time.time()
+
+        next_flush = time.monotonic()
+        while True:
+            timeout = max(next_flush - time.monotonic(), 0)
+            if select.select([self._inotify.fd], [], [], timeout)[0]:
+                for event in self._inotify.read_events():
+                    self._handle_event(*event)
+
+            if time.monotonic() >= next_flush:
+                self._flush()
+                next_flush = time.monotonic() + self._flush_interval_sec
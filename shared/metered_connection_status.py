@@ -1,42 +1,176 @@
-import subprocess
-from collections import Counter
+import dataclasses
+import hashlib
+import heapq
+import json
+import selectors
+import time
+from typing import Collection, Final, Iterable
 
-COMMAND = "nmcli -t -m multiline -f GENERAL.DEVICE,GENERAL.TYPE,GENERAL.STATE,GENERAL.METERED dev show".split()
-PING_TARGETS = Counter(["1.1.1.1", "8.8.8.8"])
-PING_CMD = "ping -I {interface} -q -c 1 -w 3 {target}"
+from shared.cache import CACHE_DIR, load_cache, save_cache
+from shared.network_state import Device, get_network_state
+from shared.reachability import Probe, start_probe
 
+PING_TARGETS: Final[tuple[str, ...]] = ("1.1.1.1", "8.8.8.8")
+PING_TIMEOUT_SEC: Final[int] = 3
 
-def ping_interface(interface: str) -> bool:
-    for target, _count in PING_TARGETS.most_common():
+PING_STATS_FILE: Final = CACHE_DIR / "ping_targets.json"
+# Weight of the newest latency in its moving average
+LATENCY_EWMA_ALPHA: Final[float] = 0.3
+# Other targets are probed only if the best one has not answered within this many of its usual latencies
+HEDGE_LATENCY_MULTIPLIER: Final[float] = 3
+
+VERDICT_CACHE_FILE: Final = CACHE_DIR / "metered_connection_status.json"
+# Reachability can change without any change of the devices, e.g. when the router loses its uplink
+VERDICT_TTL_SEC: Final[int] = 5 * 60
+NO_CONNECTION_VERDICT_TTL_SEC: Final[int] = 30
+
+
+@dataclasses.dataclass
+class TargetStats:
+    successes: int = 0
+    failures: int = 0
+    latency_ewma_sec: float | None = None
+
+    def record(self, success: bool, latency_sec: float) -> None:
+        if not success:
+            self.failures += 1
+            return
+
+        self.successes += 1
+        if self.latency_ewma_sec is None:
+            self.latency_ewma_sec = latency_sec
+        else:
+            self.latency_ewma_sec += LATENCY_EWMA_ALPHA * (latency_sec - self.latency_ewma_sec)
+
+    def sort_key(self) -> tuple[float, float]:
+        """Targets answering most often come first, then the fastest ones."""
+        # Laplace smoothing keeps one lucky reply of a new target from outranking a long reliable history
+        success_ratio = (self.successes + 1) / (self.successes + self.failures + 2)
+        return -success_ratio, self.latency_ewma_sec if self.latency_ewma_sec is not None else PING_TIMEOUT_SEC
+
+
+def load_ping_stats() -> dict[str, TargetStats]:
+    cached = load_cache(PING_STATS_FILE) or {}
+    stats = {}
+    for target in PING_TARGETS:
         try:
-            command = PING_CMD.format(interface=interface, target=target).split()
-            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            PING_TARGETS[target] += 1
-            return True
-        except subprocess.CalledProcessError:
-            pass
+            stats[target] = TargetStats(**cached.get(target, {}))
+        except TypeError:
+            stats[target] = TargetStats()
+    return stats
+
+
+def _hedge_delay_sec(best: TargetStats) -> float:
+    if best.latency_ewma_sec is None:
+        return 0
+    return min(best.latency_ewma_sec * HEDGE_LATENCY_MULTIPLIER, PING_TIMEOUT_SEC / 3)
+
 
-    return False
+def reachable_interfaces(
+    interfaces: Iterable[str], decisive: Collection[str] = (), deadline_sec: float = PING_TIMEOUT_SEC
+) -> set[str]:
+    """Probes targets through every interface at once and returns the interfaces that got a reply.
+
+    The target with the best record across runs is probed first. The others follow only if it has not answered
+    within a few of its usual latencies. Once an interface gets a reply, its other probes are closed or never started.
+    Once any of `decisive` gets a reply, all of them are. Probes still waiting at the deadline count as failed.
+    """
+    stats = load_ping_stats()
+    targets = sorted(PING_TARGETS, key=lambda target: stats[target].sort_key())
+    started = time.monotonic()
+    deadline = started + deadline_sec
+    hedge_delay_sec = _hedge_delay_sec(stats[targets[0]])
+
+    # (start time, order, interface, target) of probes not started yet
+    scheduled = [
+        (started + (0 if index == 0 else hedge_delay_sec), order, interface, target)
+        for order, (interface, (index, target)) in enumerate(
+            (interface, indexed) for interface in interfaces for indexed in enumerate(targets)
+        )
+    ]
+    heapq.heapify(scheduled)
+    probes: dict[Probe, float] = {}
+    reachable = set()
+
+    def close(probe: Probe) -> None:
+        selector.unregister(probe)
+        probe.close()
+        del probes[probe]
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            while (now := time.monotonic()) < deadline:
+                while scheduled and scheduled[0][0] <= now:
+                    _, _, interface, target = heapq.heappop(scheduled)
+                    if interface in reachable:
+                        continue
+                    try:
+                        probe = start_probe(interface, target)
+                    except OSError:
+                        stats[target].record(False, 0)
+                        continue
+                    selector.register(probe, probe.events)
+                    probes[probe] = time.monotonic()
+
+                if not scheduled and not probes:
+                    break
+
+                timeout_sec = min(deadline, scheduled[0][0] if scheduled else deadline) - time.monotonic()
+                for key, _ in selector.select(max(timeout_sec, 0)):
+                    probe = key.fileobj
+                    if (success := probe.result()) is None:
+                        continue
+
+                    stats[probe.target].record(success, time.monotonic() - probes[probe])
+                    close(probe)
+                    if not success or probe.interface in reachable:
+                        continue
+
+                    reachable.add(probe.interface)
+                    if probe.interface in decisive:
+                        return reachable
+
+                for probe in [probe for probe in probes if probe.interface in reachable]:
+                    close(probe)
+
+            for probe in probes:
+                stats[probe.target].record(False, deadline_sec)
+            return reachable
+        finally:
+            # Probes cut short by a decisive reply through another interface are not counted as failed
+            for probe in list(probes):
+                close(probe)
+            save_cache(PING_STATS_FILE, {target: dataclasses.asdict(stats[target]) for target in PING_TARGETS})
+
+
+def ping_interface(interface: str) -> bool:
+    return interface in reachable_interfaces([interface], decisive=[interface])
+
+
+def _devices_key(devices: list[Device]) -> str:
+    return hashlib.sha256(json.dumps([dataclasses.astuple(device) for device in devices]).encode()).hexdigest()
 
 
 def is_internet_connection_metered(interface_types: list[str] = ("wifi", "ethernet", "wireguard", "tun")) -> bool | None:
-    stdout = subprocess.run(COMMAND, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout
+    devices = [
+        device for device in get_network_state().devices if device.type in interface_types and device.is_connected
+    ]
+
+    # While the devices stay the same, so most likely does the verdict
+    key = _devices_key(devices)
+    if (cached := load_cache(VERDICT_CACHE_FILE, VERDICT_TTL_SEC)) is not None and cached["key"] == key:
+        if cached["metered"] is not None or time.time() - cached["checked"] <= NO_CONNECTION_VERDICT_TTL_SEC:
+            return cached["metered"]
 
-    devices = []
-    for device in stdout.strip().split("\n\n"):
-        device_info = {}
-        for line in device.split("\n"):
-            key, value = line.split(":", 1)
-            device_info[key] = value.strip()
-        devices.append(device_info)
+    metered_interfaces = {device.name for device in devices if device.metered == "yes"}
 
-    metered = None
-    for device in devices:
-        if device["GENERAL.TYPE"] in interface_types:
-            if "connected" in device["GENERAL.STATE"] and ping_interface(device["GENERAL.DEVICE"]):
-                metered = False
+    # A reachable metered interface decides the result, so probes of the others are not waited for
+    reachable = reachable_interfaces([device.name for device in devices], decisive=metered_interfaces)
 
-                if device["GENERAL.METERED"] == "yes":
-                    return True
+    if reachable & metered_interfaces:
+        metered = True
+    else:
+        metered = False if reachable else None
 
+    save_cache(VERDICT_CACHE_FILE, {"key": key, "metered": metered, "checked": time.time()})
     return metered
@@ -0,0 +1,119 @@
+"""Collects timings and values of one script run and exports them for graphing.
+
+The Prometheus textfile is meant for the node exporter textfile collector and holds only the latest run.
+The JSON lines file keeps every run, so trends over weeks can be plotted from it.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Final, Iterator
+
+from shared.cache import write_atomically
+
+DEFAULT_BUCKETS: Final[tuple[float, ...]] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+class Metrics:
+    def __init__(self, namespace: str):
+        self._namespace = namespace
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._spans: list[dict] = []
+        self._gauges: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+        self._histograms: dict[str, dict[tuple[tuple[str, str], ...], dict]] = {}
+
+    @contextmanager
+    def span(self, phase: str, **labels: str) -> Iterator[None]:
+        started = time.time()
+        started_perf = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(phase, started, time.perf_counter() - started_perf, **labels)
+
+    def add_span(self, phase: str, started: float, duration_sec: float, **labels: str) -> None:
+        with self._lock:
+            self._spans.append({"phase": phase, "start": started, "duration": duration_sec, **labels})
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[tuple(labels.items())] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **labels: str) -> None:
+        """Adds `value` to a histogram. Bucket counts are cumulative, like in Prometheus."""
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {}).setdefault(
+                tuple(labels.items()), {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+            )
+            for index, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            lines.append(f"# TYPE {self._namespace}_phase_duration_seconds gauge")
+            for span in self._spans:
+                labels = {key: value for key, value in span.items() if key not in ("start", "duration")}
+                lines.append(f"{self._namespace}_phase_duration_seconds{_format_labels(labels)} {span['duration']}")
+
+            for name, samples in self._gauges.items():
+                lines.append(f"# TYPE {self._namespace}_{name} gauge")
+                for labels, value in samples.items():
+                    lines.append(f"{self._namespace}_{name}{_format_labels(dict(labels))} {value}")
+
+            for name, samples in self._histograms.items():
+                lines.append(f"# TYPE {self._namespace}_{name} histogram")
+                for labels, histogram in samples.items():
+                    for bound, count in [*zip(histogram["buckets"], histogram["counts"]), ("+Inf", histogram["count"])]:
+                        bucket_labels = _format_labels(dict(labels) | {"le": bound})
+                        lines.append(f"{self._namespace}_{name}_bucket{bucket_labels} {count}")
+                    lines.append(f"{self._namespace}_{name}_sum{_format_labels(dict(labels))} {histogram['sum']}")
+                    lines.append(f"{self._namespace}_{name}_count{_format_labels(dict(labels))} {histogram['count']}")
+
+            lines.append(f"# TYPE {self._namespace}_last_run_timestamp_seconds gauge")
+            lines.append(f"{self._namespace}_last_run_timestamp_seconds {self._started}")
+
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> str:
+        with self._lock:
+            gauges = [
+                {"name": name, "value": value, **dict(labels)}
+                for name, samples in self._gauges.items()
+                for labels, value in samples.items()
+            ]
+            histograms = [
+                {
+                    "name": name,
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                    "buckets": dict(zip(map(str, histogram["buckets"]), histogram["counts"])),
+                    **dict(labels),
+                }
+                for name, samples in self._histograms.items()
+                for labels, histogram in samples.items()
+            ]
+            return json.dumps(
+                {"timestamp": self._started, "spans": self._spans, "gauges": gauges, "histograms": histograms}
+            )
+
+    def export(self, textfile: Path | None, jsonl_file: Path | None) -> None:
+        if textfile is not None:
+            write_atomically(textfile, self.to_prometheus())
+
+        if jsonl_file is not None:
+            jsonl_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(jsonl_file, "a") as file:
+                file.write(self.to_json() + "\n")
@@ -0,0 +1,185 @@
+"""Snapshot of NetworkManager devices, active connections and Wi-Fi networks, shared by all scripts.
+
+The status bar, backups and the VPN daemon ask about the network many times a minute. The snapshot is collected
+with concurrent `nmcli` calls and cached for a few seconds, so they share one query instead of forking their own.
+
+Snapshots of root, e.g. of the backup run from its cron, are shared with all users. Root never reads snapshots of
+other users, so they cannot make the backup act on a spoofed state.
+"""
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Final
+
+from shared.cache import CACHE_DIR, SHARED_CACHE_DIR, load_cache, make_shared_cache_dir, save_cache
+
+SHARED_NETWORK_STATE_FILE: Final = SHARED_CACHE_DIR / "network_state.json"
+USER_NETWORK_STATE_FILE: Final = CACHE_DIR / "network_state.json"
+# Snapshots written before this file was last modified are outdated, see `invalidate_network_state`
+NETWORK_STATE_INVALIDATED_FILE: Final = CACHE_DIR / "network_state.invalidated"
+NETWORK_STATE_TTL_SEC: Final[int] = 5
+
+# Can point to a fake nmcli in tests
+NMCLI: Final[str] = os.environ.get("NMCLI", "nmcli")
+DEVICES_COMMAND: Final[list[str]] = [
+    NMCLI,
+    *"-t -m multiline -f GENERAL.DEVICE,GENERAL.TYPE,GENERAL.STATE,GENERAL.METERED,GENERAL.CONNECTION dev show".split(),
+]
+ACTIVE_CONNECTIONS_COMMAND: Final[list[str]] = [NMCLI, *"-t -f NAME,TYPE,STATE,DEVICE connection show --active".split()]
+# Without '--rescan no', nmcli may scan for networks first, which takes seconds
+WIFI_COMMAND: Final[list[str]] = [NMCLI, *"-t -f ACTIVE,SSID dev wifi list --rescan no".split()]
+
+
+@dataclass(frozen=True)
+class Device:
+    name: str
+    type: str
+    state: str
+    metered: str
+    connection: str
+
+    @property
+    def is_connected(self) -> bool:
+        return "connected" in self.state and "disconnected" not in self.state
+
+
+@dataclass(frozen=True)
+class ActiveConnection:
+    name: str
+    type: str
+    state: str
+    device: str
+
+
+@dataclass(frozen=True)
+class NetworkState:
+    devices: tuple[Device, ...]
+    active_connections: tuple[ActiveConnection, ...]
+    active_wifi_ssids: tuple[str, ...]
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "NetworkState":
+        return cls(
+            devices=tuple(Device(**device) for device in data["devices"]),
+            active_connections=tuple(ActiveConnection(**connection) for connection in data["active_connections"]),
+            active_wifi_ssids=tuple(data["active_wifi_ssids"]),
+        )
+
+
+def _run(command: list[str], check: bool = True) -> str:
+    return subprocess.run(command, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout
+
+
+def _split_terse(line: str) -> list[str]:
+    """Splits a line of `nmcli -t` output on colons, which are escaped with a backslash inside values."""
+    fields, field, escaped = [], [], False
+    for char in line:
+        if escaped:
+            field.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == ":":
+            fields.append("".join(field))
+            field = []
+        else:
+            field.append(char)
+
+    fields.append("".join(field))
+    return fields
+
+
+def _parse_devices(stdout: str) -> tuple[Device, ...]:
+    devices, device = [], {}
+    for line in stdout.splitlines():
+        if not line:
+            continue
+
+        key, value = line.split(":", 1)
+        if key == "GENERAL.DEVICE" and device:
+            devices.append(device)
+            device = {}
+        device[key.removeprefix("GENERAL.").lower()] = value.strip()
+
+    if device:
+        devices.append(device)
+
+    return tuple(
+        Device(
+            name=device.get("device", ""),
+            type=device.get("type", ""),
+            state=device.get("state", ""),
+            metered=device.get("metered", ""),
+            connection=device.get("connection", ""),
+        )
+        for device in devices
+    )
+
+
+def _parse_active_connections(stdout: str) -> tuple[ActiveConnection, ...]:
+    return tuple(ActiveConnection(*_split_terse(line)[:4]) for line in stdout.splitlines() if line)
+
+
+def _parse_active_wifi_ssids(stdout: str) -> tuple[str, ...]:
+    networks = (_split_terse(line)[:2] for line in stdout.splitlines() if line)
+    return tuple(ssid for active, ssid in networks if active == "yes")
+
+
+def collect_network_state() -> NetworkState:
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        devices = executor.submit(_run, DEVICES_COMMAND)
+        active_connections = executor.submit(_run, ACTIVE_CONNECTIONS_COMMAND)
+        # Fails on machines without a Wi-Fi device, which then have no Wi-Fi networks either
+        wifi = executor.submit(_run, WIFI_COMMAND, check=False)
+        devices, active_connections, wifi = devices.result(), active_connections.result(), wifi.result()
+
+    return NetworkState(
+        devices=_parse_devices(devices),
+        active_connections=_parse_active_connections(active_connections),
+        active_wifi_ssids=_parse_active_wifi_ssids(wifi),
+    )
+
+
+def _is_root() -> bool:
+    return os.geteuid() == 0
+
+
+def _modified(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0
+
+
+def get_network_state(max_age_sec: float = NETWORK_STATE_TTL_SEC) -> NetworkState:
+    """Returns a snapshot at most `max_age_sec` old, collecting a new one if no cached one is as fresh."""
+    invalidated = _modified(NETWORK_STATE_INVALIDATED_FILE)
+    paths = [SHARED_NETWORK_STATE_FILE] if _is_root() else [SHARED_NETWORK_STATE_FILE, USER_NETWORK_STATE_FILE]
+    for path in sorted(paths, key=_modified, reverse=True):
+        if _modified(path) <= invalidated or (cached := load_cache(path, max_age_sec)) is None:
+            continue
+        try:
+            return NetworkState.from_json(cached)
+        except (KeyError, TypeError):
+            pass
+
+    state = collect_network_state()
+    try:
+        if _is_root():
+            make_shared_cache_dir()
+        save_cache(SHARED_NETWORK_STATE_FILE if _is_root() else USER_NETWORK_STATE_FILE, asdict(state))
+    except OSError:
+        # Only the next caller misses the snapshot
+        pass
+    return state
+
+
+def invalidate_network_state() -> None:
+    """Makes the next `get_network_state` collect a new snapshot, e.g. after changing a connection.
+
+    Snapshots of root cannot be deleted by other users, so all snapshots written until now are ignored instead.
+    """
+    NETWORK_STATE_INVALIDATED_FILE.parent.mkdir(parents=True, exist_ok=True)
+    NETWORK_STATE_INVALIDATED_FILE.touch()
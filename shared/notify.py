@@ -56,6 +56,16 @@ class Notifier:
         self.send_notification("network-error", "normal", message, body)
 
 
+class NullNotifier(Notifier):
+    """Drops all notifications, for runs without a desktop session such as benchmarks."""
+
+    def __init__(self):
+        pass
+
+    def send_notification(self, icon: str, urgency: str, message: str, body: str | None = None):
+        pass
+
+
 if __name__ == "__main__":
     notifier = Notifier()
     notifier.info("Hello", "This is a test message.")
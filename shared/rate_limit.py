@@ -0,0 +1,167 @@
+"""Keeps independent processes calling the same API within its rate limit.
+
+Processes share the limiter state through files guarded with `flock`. A process honouring `Retry-After` therefore
+holds back the others too. Identical requests sent at the same moment are coalesced into one upstream call.
+"""
+import fcntl
+import hashlib
+import json
+import random
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Any, Callable, Final, Iterator, Protocol
+
+from shared.cache import load_cache, save_cache
+
+RETRY_STATUS_CODES: Final[frozenset[int]] = frozenset({429, 500, 502, 503, 504})
+# Responses of coalesced requests are only read by processes waiting at the same time, so they expire quickly
+COALESCED_RESPONSE_MAX_AGE_SEC: Final[int] = 60
+# Keys share a fixed set of lock files, which unlike per-key ones never pile up and are never deleted under a lock
+COALESCING_LOCKS: Final[int] = 16
+
+
+@contextmanager
+def _locked(lock_file: Path) -> Iterator[None]:
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class RateLimiter:
+    """Token bucket refilled at `rate_per_sec` up to `burst` tokens, shared by all processes using `state_file`."""
+
+    def __init__(self, state_file: Path, rate_per_sec: float, burst: int):
+        self._state_file = state_file
+        self._lock_file = state_file.with_suffix(".lock")
+        self._rate_per_sec = rate_per_sec
+        self._burst = burst
+
+    def _read_state(self, now: float) -> dict[str, float]:
+        try:
+            state = json.loads(self._state_file.read_text())
+        except (OSError, ValueError):
+            return {"tokens": self._burst, "updated": now, "blocked_until": 0}
+
+        elapsed_sec = max(now - state["updated"], 0)
+        state["tokens"] = min(state["tokens"] + elapsed_sec * self._rate_per_sec, self._burst)
+        state["updated"] = now
+        return state
+
+    def acquire(self) -> None:
+        """Blocks until a request may be sent."""
+        while True:
+            with _locked(self._lock_file):
+                now = time.time()
+                state = self._read_state(now)
+                if now < state["blocked_until"]:
+                    wait_sec = state["blocked_until"] - now
+                elif state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    wait_sec = 0
+                else:
+                    wait_sec = (1 - state["tokens"]) / self._rate_per_sec
+                self._state_file.write_text(json.dumps(state))
+
+            if not wait_sec:
+                return
+            time.sleep(wait_sec)
+
+    def block_until(self, timestamp: float) -> None:
+        """Holds back all processes, e.g. until the time the server asked for in `Retry-After`."""
+        with _locked(self._lock_file):
+            state = self._read_state(time.time())
+            state["blocked_until"] = max(state["blocked_until"], timestamp)
+            self._state_file.write_text(json.dumps(state))
+
+
+def retry_after_sec(value: str | None) -> float | None:
+    """Parses `Retry-After`, which holds either seconds or an HTTP date."""
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Response(Protocol):
+    status_code: int
+    headers: Any
+
+
+def send_with_retries(
+    send: Callable[[], Response],
+    limiter: RateLimiter,
+    max_attempts: int,
+    backoff_sec: float,
+    retry_exceptions: tuple[type[Exception], ...] = (),
+) -> Response:
+    """Sends a request within the rate limit and retries it on rate limiting, server errors and `retry_exceptions`.
+
+    The last response is returned even if it failed, so the caller decides how to report the error.
+    """
+    for attempt in range(max_attempts):
+        limiter.acquire()
+        last_attempt = attempt == max_attempts - 1
+        try:
+            response = send()
+        except retry_exceptions:
+            if last_attempt:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                return response
+
+            if (delay_sec := retry_after_sec(response.headers.get("Retry-After"))) is not None:
+                # The limiter waits for it, in this process and in all others
+                limiter.block_until(time.time() + delay_sec)
+                continue
+
+        # Jitter keeps processes failing at the same moment from retrying at the same moment too
+        time.sleep(backoff_sec * 2**attempt * random.uniform(0.5, 1.5))
+
+    raise AssertionError("Unreachable, the last attempt returns or raises.")
+
+
+class RequestCoalescer:
+    """Shares one upstream call between processes asking for the same response at the same time.
+
+    The first process takes the lock of the key and stores the response. Processes waiting for the lock meanwhile read
+    the stored response instead of sending the request again.
+    """
+
+    def __init__(self, directory: Path):
+        self._directory = directory
+
+    def get(self, key: str, fetch: Callable[[], Any]) -> Any:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        response_file = self._directory / f"{digest[:32]}.json"
+        requested_at = time.time()
+
+        with _locked(self._directory / f"{int(digest, 16) % COALESCING_LOCKS}.lock"):
+            # Only a response stored after this request started waiting was in flight at the same time
+            if (data := load_cache(response_file, ttl_sec=time.time() - requested_at)) is not None:
+                return data
+
+            data = fetch()
+            save_cache(response_file, data)
+
+        self._remove_expired()
+        return data
+
+    def _remove_expired(self) -> None:
+        for path in self._directory.glob("*.json"):
+            try:
+                if time.time() - path.stat().st_mtime > COALESCED_RESPONSE_MAX_AGE_SEC:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,122 @@
+"""Probes checking whether a target answers through a given interface, run from one select loop without forking.
+
+ICMP echo requests are sent through unprivileged datagram sockets, which are allowed to the groups in
+`net.ipv4.ping_group_range`. Where they are not, a TCP connection is attempted instead. A refused connection still
+proves the target answered.
+
+Probes are bound to their interface with `SO_BINDTODEVICE`, which needs Linux 5.7 or newer, or CAP_NET_RAW before
+that. Without it, a probe could leave through another interface and report the wrong one as reachable, so it fails.
+"""
+import errno
+import itertools
+import selectors
+import socket
+import struct
+from abc import ABC, abstractmethod
+from typing import Final
+
+ICMP_ECHO_REPLY: Final[int] = 0
+ICMP_ECHO_REQUEST: Final[int] = 8
+_ICMP_HEADER: Final[struct.Struct] = struct.Struct("!BBHHH")
+# Both default targets serve DNS over HTTPS
+TCP_FALLBACK_PORT: Final[int] = 443
+# Results of a connection attempt that came from the target itself
+_ANSWERED_ERRNOS: Final[frozenset[int]] = frozenset({0, errno.ECONNREFUSED})
+
+_sequence = itertools.count()
+
+
+def _bind_to_interface(sock: socket.socket, interface: str) -> None:
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE, interface.encode())
+    except PermissionError as e:
+        # Binding to the address of the interface instead would not do, routes can still send packets elsewhere. Not a
+        # PermissionError, which would make `start_probe` fall back to TCP, where binding fails just the same.
+        raise OSError(f"Binding a probe to {interface} needs Linux 5.7 or CAP_NET_RAW") from e
+
+
+class Probe(ABC):
+    """A single attempt to reach `target` through `interface`, started on creation.
+
+    Once its socket is ready for `events`, `result` tells whether the target answered, or None to keep waiting.
+    """
+
+    events: int
+
+    def __init__(self, interface: str, target: str, sock: socket.socket):
+        self.interface = interface
+        self.target = target
+        self.socket = sock
+
+    def fileno(self) -> int:
+        return self.socket.fileno()
+
+    @abstractmethod
+    def result(self) -> bool | None:
+        pass
+
+    def close(self) -> None:
+        self.socket.close()
+
+
+class IcmpProbe(Probe):
+    events = selectors.EVENT_READ
+
+    def __init__(self, interface: str, target: str):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        try:
+            sock.setblocking(False)
+            _bind_to_interface(sock, interface)
+            # Connected, so ICMP errors such as an unreachable host are reported on the socket
+            sock.connect((target, 0))
+            self._sequence = next(_sequence) & 0xFFFF
+            # The kernel fills in the identifier and the checksum
+            sock.send(_ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, 0, self._sequence))
+        except BaseException:
+            sock.close()
+            raise
+        super().__init__(interface, target, sock)
+
+    def result(self) -> bool | None:
+        try:
+            reply = self.socket.recv(1024)
+        except BlockingIOError:
+            return None
+        except OSError:
+            return False
+
+        if len(reply) < _ICMP_HEADER.size:
+            return None
+        icmp_type, _, _, _, sequence = _ICMP_HEADER.unpack_from(reply)
+        return True if icmp_type == ICMP_ECHO_REPLY and sequence == self._sequence else None
+
+
+class TcpProbe(Probe):
+    events = selectors.EVENT_WRITE
+
+    def __init__(self, interface: str, target: str, port: int = TCP_FALLBACK_PORT):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            _bind_to_interface(sock, interface)
+            if (code := sock.connect_ex((target, port))) not in _ANSWERED_ERRNOS | {errno.EINPROGRESS}:
+                raise OSError(code, f"Connecting to {target}:{port} through {interface} failed")
+        except BaseException:
+            sock.close()
+            raise
+        super().__init__(interface, target, sock)
+
+    def result(self) -> bool | None:
+        return self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) in _ANSWERED_ERRNOS
+
+
+def start_probe(interface: str, target: str) -> Probe:
+    """Starts an ICMP probe, or a TCP one if ICMP datagram sockets are not allowed.
+
+    Raises OSError if the target cannot be reached through the interface at all, e.g. for lack of a route, or if
+    the probe cannot be bound to the interface.
+    """
+    try:
+        return IcmpProbe(interface, target)
+    except PermissionError:
+        return TcpProbe(interface, target)
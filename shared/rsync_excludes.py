@@ -0,0 +1,157 @@
+"""Evaluates `--exclude` patterns the way rsync does, so their effect can be checked without running rsync.
+
+Paths are relative to the transfer root, e.g. 'rlat/.cache/pip' for source '/home/rlat' without a trailing slash.
+"""
+import os
+import re
+from dataclasses import dataclass, field
+from functools import cache
+from typing import Final, Iterable
+
+CACHE_LIKE_NAME: Final[re.Pattern] = re.compile(
+    r"(?i)(cache|caches|cache2|tmp|temp|logs?|\.gradle|\.m2|node_modules|\.tox|\.nox|\.cargo|\.rustup|\.conda)$"
+)
+
+
+def _translate(pattern: str) -> str:
+    regex = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("/***", index) and index + 4 == len(pattern):
+            # 'dir/***' matches the folder itself and everything in it
+            regex.append("(/.*)?")
+            index += 4
+        elif pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+        elif (char := pattern[index]) == "*":
+            regex.append("[^/]*")
+            index += 1
+        elif char == "?":
+            regex.append("[^/]")
+            index += 1
+        elif char == "[" and (end := pattern.find("]", index + 2)) != -1:
+            regex.append(pattern[index : end + 1].replace("[!", "[^", 1))
+            index = end + 1
+        elif char == "\\" and index + 1 < len(pattern):
+            regex.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            regex.append(re.escape(char))
+            index += 1
+
+    return "".join(regex)
+
+
+@dataclass(frozen=True)
+class ExcludeRule:
+    pattern: str
+    regex: re.Pattern
+    directories_only: bool
+
+    @classmethod
+    def parse(cls, pattern: str) -> "ExcludeRule":
+        body = pattern.removesuffix("/") if pattern != "/" else pattern
+        # Anchored patterns match from the transfer root, others match the end of the path at a folder boundary
+        prefix = "^" if body.startswith("/") else "(^|/)"
+        regex = re.compile(f"{prefix}{_translate(body.removeprefix('/'))}$")
+        return cls(pattern=pattern, regex=regex, directories_only=pattern.endswith("/"))
+
+    def matches(self, path: str, is_dir: bool) -> bool:
+        return (is_dir or not self.directories_only) and self.regex.search(path) is not None
+
+
+class ExcludeRules:
+    def __init__(self, patterns: Iterable[str]):
+        self.rules = [ExcludeRule.parse(pattern) for pattern in patterns]
+
+    def match(self, path: str, is_dir: bool) -> str | None:
+        """Returns the first pattern excluding `path`. Like in rsync, only the first match counts."""
+        for rule in self.rules:
+            if rule.matches(path, is_dir):
+                return rule.pattern
+        return None
+
+
+@cache
+def exclude_rules(patterns: tuple[str, ...]) -> ExcludeRules:
+    return ExcludeRules(patterns)
+
+
+@dataclass
+class TreeStats:
+    files: int = 0
+    bytes: int = 0
+
+    def add(self, other: "TreeStats") -> None:
+        self.files += other.files
+        self.bytes += other.bytes
+
+
+@dataclass
+class ExcludeReport:
+    included: TreeStats = field(default_factory=TreeStats)
+    pruned: dict[str, TreeStats] = field(default_factory=dict)
+    candidates: dict[str, TreeStats] = field(default_factory=dict)
+
+
+def _entry_size(entry: os.DirEntry) -> int:
+    try:
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+
+def _tree_stats(path: str) -> TreeStats:
+    stats = TreeStats()
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+
+        for entry in entries:
+            stats.files += 1
+            stats.bytes += _entry_size(entry)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+
+    return stats
+
+
+def _analyze_tree(path: str, relative_path: str, rules: ExcludeRules, report: ExcludeReport) -> TreeStats:
+    stats = TreeStats()
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return stats
+
+    for entry in entries:
+        entry_relative_path = f"{relative_path}/{entry.name}"
+        is_dir = entry.is_dir(follow_symlinks=False)
+        entry_stats = TreeStats(files=1, bytes=_entry_size(entry))
+
+        if (pattern := rules.match(entry_relative_path, is_dir)) is not None:
+            if is_dir:
+                entry_stats.add(_tree_stats(entry.path))
+            report.pruned[pattern].add(entry_stats)
+            continue
+
+        if is_dir:
+            entry_stats.add(_analyze_tree(entry.path, entry_relative_path, rules, report))
+            if CACHE_LIKE_NAME.search(entry.name):
+                report.candidates[entry_relative_path] = entry_stats
+
+        stats.add(entry_stats)
+
+    return stats
+
+
+def analyze_excludes(source: str, patterns: Iterable[str]) -> ExcludeReport:
+    """Walks `source` once and reports what each pattern prunes and which cache-like folders are still sent."""
+    rules = ExcludeRules(patterns)
+    report = ExcludeReport(pruned={rule.pattern: TreeStats() for rule in rules.rules})
+    root = os.path.basename(source.rstrip("/"))
+    report.included = _analyze_tree(source, root, rules, report)
+    return report
@@ -0,0 +1,53 @@
+"""Records of Toggl API responses.
+
+They are plain tuples parsed straight from the JSON, because validating every entry with pydantic took most of
+the run time of `toggl_time_tracked.py`. Importing this module costs no more than the standard library.
+"""
+import dataclasses
+from datetime import date, datetime
+from typing import Any, Iterable, NamedTuple
+
+
+def _parse_datetime(value: str | None) -> datetime | None:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+@dataclasses.dataclass(frozen=True)
+class Budget:
+    hours_per_day: int
+    days_per_week: int = 5
+
+    def expected_seconds(self, days: Iterable[date]) -> int:
+        return self.hours_per_day * 60 * 60 * sum(1 for day in days if day.weekday() < self.days_per_week)
+
+
+class TogglTimeEntry(NamedTuple):
+    id: int | None
+    project_id: int | None
+    duration: int
+    duronly: bool
+    start: datetime
+    stop: datetime | None = None
+    server_deleted_at: datetime | None = None
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "TogglTimeEntry":
+        return cls(
+            data.get("id"),
+            data.get("project_id"),
+            data["duration"],
+            data["duronly"],
+            datetime.fromisoformat(data["start"]),
+            _parse_datetime(data.get("stop")),
+            _parse_datetime(data.get("server_deleted_at")),
+        )
+
+
+class TogglProject(NamedTuple):
+    id: int
+    name: str
+    client_id: int | None
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "TogglProject":
+        return cls(data["id"], data["name"], data.get("client_id"))
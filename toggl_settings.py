@@ -0,0 +1,15 @@
+"""Settings of `toggl_time_tracked.py`, kept apart because importing pydantic takes longer than most runs."""
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from toggl_models import Budget
+
+
+class Settings(BaseSettings):
+    API_TOKEN: str
+    WORKSPACE_ID: int
+    BUDGETS: dict[int, Budget] = Field(default_factory=dict)
+    SEPARATOR: str = "  |  "
+    PROJECTS_CACHE_TTL_SEC: int = 24 * 60 * 60
+    REFRESH_INTERVAL_SEC: int = 60
+    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", env_prefix="toggl_")
@@ -4,46 +4,48 @@
 Toggl API documentation: https://engineering.toggl.com/docs/
 """
 import dataclasses
+import fcntl
+import hashlib
+import json
+import subprocess
+import time
 from base64 import b64encode
+from bisect import bisect_right
 from collections import defaultdict
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
 from enum import StrEnum
-from functools import cache
-from sys import argv
-from typing import Any
+from functools import cache, cached_property, partial
+from pathlib import Path
+from sys import argv, executable
+from typing import TYPE_CHECKING, Any, Final, Iterable
 
-import requests
-from pydantic import ConfigDict, BaseModel, Field
-from pydantic_settings import BaseSettings, SettingsConfigDict
+from shared.cache import CACHE_DIR, invalidate_cache, load_cache, save_cache
+from shared.rate_limit import RateLimiter, RequestCoalescer, send_with_retries
+from toggl_models import Budget, TogglProject, TogglTimeEntry
 
+if TYPE_CHECKING:
+    import sqlite3
 
-class Budget(BaseModel):
-    hours_per_day: int
-    days_per_week: int = 5
+    import requests
 
+    from toggl_settings import Settings
 
-class Settings(BaseSettings):
-    API_TOKEN: str
-    WORKSPACE_ID: int
-    BUDGETS: dict[int, Budget] = Field(default_factory=list)
-    SEPARATOR: str = "  |  "
-    model_config = SettingsConfigDict(env_file=".env", env_file_encoding="utf-8", env_prefix="toggl_")
 
+@dataclasses.dataclass(frozen=True)
+class ProjectIndex:
+    projects_to_client: dict[int, int | None]
 
-class TogglTimeEntry(BaseModel):
-    project_id: int | None = None
-    duration: int
-    duronly: bool
-    start: datetime
-    stop: datetime | None = None
-    model_config = ConfigDict(extra="ignore")
+    @classmethod
+    def from_projects(cls, projects: list[TogglProject]) -> "ProjectIndex":
+        return cls({project.id: project.client_id for project in projects})
 
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "ProjectIndex":
+        # JSON object keys can only be strings, so the map is stored as a list of pairs
+        return cls(dict(data["projects_to_client"]))
 
-class TogglProject(BaseModel):
-    id: int
-    name: str
-    client_id: int | None
-    model_config = ConfigDict(extra="ignore")
+    def to_json(self) -> dict[str, Any]:
+        return {"projects_to_client": list(self.projects_to_client.items())}
 
 
 class State(StrEnum):
@@ -52,131 +54,470 @@ class State(StrEnum):
     NOT_RUNNING = "⚪️"
 
 
-settings = Settings()
+PERIODS: Final[tuple[str, ...]] = ("week", "month", "quarter", "year")
+
+
+@dataclasses.dataclass(frozen=True)
+class Period:
+    """Local calendar days from `start` up to, but not including, `end`."""
+
+    start: date
+    end: date
+
+    @classmethod
+    def of(cls, kind: str, today: date) -> "Period":
+        if kind == "week":
+            start = today - timedelta(days=today.weekday())
+            return cls(start, start + timedelta(days=7))
+
+        if kind == "year":
+            return cls(date(today.year, 1, 1), date(today.year + 1, 1, 1))
+
+        months = {"month": 1, "quarter": 3}[kind]
+        start_month = (today.month - 1) // months * months
+        end_month = start_month + months
+        return cls(
+            date(today.year, start_month + 1, 1),
+            date(today.year + end_month // 12, end_month % 12 + 1, 1),
+        )
+
+    @property
+    def since(self) -> datetime:
+        return datetime(self.start.year, self.start.month, self.start.day).astimezone()
+
+    def days(self, until: date | None = None) -> list[date]:
+        """Days of the period, optionally only those up to and including `until`."""
+        last = self.end if until is None else min(self.end, until + timedelta(days=1))
+        return [self.start + timedelta(days=offset) for offset in range((last - self.start).days)]
+
+    def day_boundaries(self) -> list[float]:
+        """UNIX timestamps of local midnights starting each day, followed by the end of the period."""
+        return [datetime(day.year, day.month, day.day).timestamp() for day in [*self.days(), self.end]]
+
+
+@dataclasses.dataclass
+class Rollup:
+    period: Period
+    # Keyed by client, where None stands for projects without a client
+    per_client_sec: defaultdict[int | None, float]
+    per_project_sec: defaultdict[int | None, float]
+    # Time without a project or on a project missing from the index, which belongs to no client
+    unassigned_sec: float
+    # Indexed by the position of the day in `period.days()`
+    per_day_sec: list[float]
+    per_client_day_sec: dict[int | None, list[float]]
+
+    def client_days(self, client_id: int | None) -> dict[str, float]:
+        days_sec = self.per_client_day_sec.get(client_id, ())
+        return {day.isoformat(): sec for day, sec in zip(self.period.days(), days_sec) if sec}
+
+
+def aggregate(
+    time_entries: Iterable[tuple[int | None, int, int]],
+    period: Period,
+    projects_to_client: dict[int, int | None],
+    now: float,
+) -> Rollup:
+    """Sums `(project_id, start, duration)` rows in one pass. Running entries count until `now`."""
+    boundaries = period.day_boundaries()
+    first, last = boundaries[0], boundaries[-1]
+    days = len(boundaries) - 1
+    per_client_sec: defaultdict[int | None, float] = defaultdict(float)
+    per_project_sec: defaultdict[int | None, float] = defaultdict(float)
+    unassigned_sec = 0.0
+    per_day_sec = [0.0] * days
+    per_client_day_sec: dict[int | None, list[float]] = {}
+
+    for project_id, start, duration in time_entries:
+        if not first <= start < last:
+            continue
+
+        if duration < 0:
+            duration = now - start
+
+        day = bisect_right(boundaries, start) - 1
+        per_project_sec[project_id] += duration
+        per_day_sec[day] += duration
+        if project_id not in projects_to_client:
+            unassigned_sec += duration
+            continue
+
+        client_id = projects_to_client[project_id]
+        per_client_sec[client_id] += duration
+        if (client_day_sec := per_client_day_sec.get(client_id)) is None:
+            client_day_sec = per_client_day_sec[client_id] = [0.0] * days
+        client_day_sec[day] += duration
+
+    return Rollup(period, per_client_sec, per_project_sec, unassigned_sec, per_day_sec, per_client_day_sec)
+
+
+@cache
+def get_settings() -> "Settings":
+    # pydantic takes longer to import than printing a cached summary, so only runs that need the settings load it
+    from toggl_settings import Settings
+
+    return Settings()
+
 
 API_DATE_FMT: str = "%Y-%m-%d"
 
+# Changes are pulled incrementally, but a full sync once in a while repairs anything the change feed missed
+FULL_SYNC_INTERVAL_SEC: Final[int] = 7 * 24 * 60 * 60
+# Requested changes overlap the previous sync to cover clock differences between this machine and the API
+SYNC_OVERLAP_SEC: Final[int] = 5 * 60
+
+# Timestamps are stored as UNIX seconds, so they can be compared with day boundaries without parsing
+TIME_ENTRIES_SCHEMA_VERSION: Final[int] = 2
+TIME_ENTRIES_SCHEMA: Final = """
+CREATE TABLE IF NOT EXISTS time_entries (
+    id INTEGER PRIMARY KEY,
+    project_id INTEGER,
+    duration INTEGER NOT NULL,
+    duronly INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER
+);
+CREATE INDEX IF NOT EXISTS time_entries_start ON time_entries (start);
+CREATE INDEX IF NOT EXISTS time_entries_project_id ON time_entries (project_id, start);
+CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value REAL NOT NULL);
+"""
+
+
+class TimeEntryStore:
+    """Local copy of time entries, so each run only needs to download the entries changed since the last one."""
+
+    def __init__(self, path: Path):
+        import sqlite3
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30)
+        if self._connection.execute("PRAGMA user_version").fetchone()[0] != TIME_ENTRIES_SCHEMA_VERSION:
+            # The store is only a copy of the API, so an outdated one is dropped and synced again
+            self._connection.executescript("DROP TABLE IF EXISTS time_entries; DROP TABLE IF EXISTS sync_state;")
+            self._connection.execute(f"PRAGMA user_version = {TIME_ENTRIES_SCHEMA_VERSION}")
+        self._connection.executescript(TIME_ENTRIES_SCHEMA)
+
+    def get_state(self, key: str) -> float | None:
+        row = self._connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key: str, value: float) -> None:
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+    def reset(self) -> None:
+        with self._connection:
+            self._connection.execute("DELETE FROM time_entries")
+            self._connection.execute("DELETE FROM sync_state")
+
+    def apply_changes(self, time_entries: Iterable[TogglTimeEntry]) -> None:
+        upserted, deleted = [], []
+        for time_entry in time_entries:
+            if time_entry.server_deleted_at is not None:
+                deleted.append((time_entry.id,))
+            else:
+                upserted.append(self._to_row(time_entry))
+
+        with self._connection:
+            self._connection.executemany("DELETE FROM time_entries WHERE id = ?", deleted)
+            self._connection.executemany("INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?, ?, ?)", upserted)
+
+    def replace_time_entries(self, since: datetime, time_entries: Iterable[TogglTimeEntry]) -> None:
+        """Replaces time entries starting from `since` with `time_entries`, keeping the older ones."""
+        rows = [self._to_row(time_entry) for time_entry in time_entries if time_entry.server_deleted_at is None]
+        with self._connection:
+            self._connection.execute("DELETE FROM time_entries WHERE start >= ?", (since.timestamp(),))
+            self._connection.executemany("INSERT OR REPLACE INTO time_entries VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def running_time_entry(self) -> TogglTimeEntry | None:
+        row = self._connection.execute(
+            "SELECT id, project_id, duration, duronly, start, stop FROM time_entries"
+            " WHERE duration < 0 ORDER BY start DESC LIMIT 1"
+        ).fetchone()
+        return None if row is None else self._to_time_entry(row)
+
+    def time_entries(self, since: datetime) -> list[TogglTimeEntry]:
+        rows = self._connection.execute(
+            "SELECT id, project_id, duration, duronly, start, stop FROM time_entries WHERE start >= ? ORDER BY start",
+            (since.timestamp(),),
+        )
+        return [self._to_time_entry(row) for row in rows]
+
+    def project_ids(self, since: datetime) -> set[int]:
+        rows = self._connection.execute(
+            "SELECT DISTINCT project_id FROM time_entries WHERE start >= ? AND project_id IS NOT NULL",
+            (since.timestamp(),),
+        )
+        return {row[0] for row in rows}
+
+    def durations(self, period: Period) -> "sqlite3.Cursor":
+        """Yields `(project_id, start, duration)` of time entries starting within `period`."""
+        boundaries = period.day_boundaries()
+        return self._connection.execute(
+            "SELECT project_id, start, duration FROM time_entries WHERE start >= ? AND start < ?",
+            (boundaries[0], boundaries[-1]),
+        )
+
+    @staticmethod
+    def _to_row(time_entry: TogglTimeEntry) -> tuple:
+        return (
+            time_entry.id,
+            time_entry.project_id,
+            time_entry.duration,
+            time_entry.duronly,
+            int(time_entry.start.timestamp()),
+            None if time_entry.stop is None else int(time_entry.stop.timestamp()),
+        )
+
+    @staticmethod
+    def _to_time_entry(row: tuple) -> TogglTimeEntry:
+        entry_id, project_id, duration, duronly, start, stop = row
+        return TogglTimeEntry(
+            id=entry_id,
+            project_id=project_id,
+            duration=duration,
+            duronly=duronly,
+            start=datetime.fromtimestamp(start, tz=timezone.utc),
+            stop=None if stop is None else datetime.fromtimestamp(stop, tz=timezone.utc),
+        )
+
 
 @dataclasses.dataclass(frozen=True)
 class TogglAPI:
     workspace_id: int
     api_token: str
     base_url: str = "https://api.track.toggl.com/api/v9"
+    projects_cache_ttl_sec: float = 24 * 60 * 60
+    cache_dir: Path = CACHE_DIR
+    # See https://engineering.toggl.com/docs/#generic-responses for the API rate limits
+    requests_per_sec: float = 1
+    burst: int = 3
+    max_attempts: int = 4
+    backoff_sec: float = 1
+    timeout_sec: float = 30
 
     @property
-    def _headers(self):
-        return {
-            "content-type": "application/json",
-            "Authorization": "Basic %s" % b64encode(f"{self.api_token}:api_token".encode()).decode("ascii"),
-        }
+    def _projects_cache_file(self) -> Path:
+        return self.cache_dir / f"toggl_projects_{self.workspace_id}.json"
+
+    @cached_property
+    def _rate_limiter(self) -> RateLimiter:
+        # Shared by all processes using the same API token
+        token_hash = hashlib.sha256(self.api_token.encode()).hexdigest()[:16]
+        return RateLimiter(self.cache_dir / f"toggl_rate_limit_{token_hash}.json", self.requests_per_sec, self.burst)
+
+    @cached_property
+    def _coalescer(self) -> RequestCoalescer:
+        return RequestCoalescer(self.cache_dir / "toggl_requests")
+
+    @cached_property
+    def _session(self) -> "requests.Session":
+        """Keeps connections alive, so only the first request pays for the TCP and TLS handshakes."""
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=4)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(
+            {
+                "content-type": "application/json",
+                "Authorization": "Basic %s" % b64encode(f"{self.api_token}:api_token".encode()).decode("ascii"),
+            }
+        )
+        return session
+
+    def _fetch(self, path: str, params: dict | None) -> Any:
+        import requests
+
+        response = send_with_retries(
+            partial(self._session.get, f"{self.base_url}/{path}", params=params, timeout=self.timeout_sec),
+            self._rate_limiter,
+            self.max_attempts,
+            self.backoff_sec,
+            retry_exceptions=(requests.ConnectionError, requests.Timeout),
+        )
+        response.raise_for_status()
+        return response.json()
 
     def _request(self, path: str, params: dict = None) -> Any:
-        data = requests.get(f"{self.base_url}/{path}", params=params, headers=self._headers)
-        data.raise_for_status()
-        return data.json()
+        """Processes sending the same request at the same time share one response."""
+        key = json.dumps([self.base_url, self.api_token, path, params], sort_keys=True)
+        return self._coalescer.get(key, partial(self._fetch, path, params))
 
     @cache
     def get_projects(self) -> list[TogglProject]:
-        """See https://engineering.toggl.com/docs/api/projects#get-workspaceprojects for more information."""
-        data = self._request(
-            f"workspaces/{self.workspace_id}/projects",
-            {"active": True},
-        )
+        """See https://engineering.toggl.com/docs/api/projects#get-workspaceprojects for more information.
 
-        return [TogglProject(**project) for project in data]
+        Archived projects are included, as time entries of this period can still belong to them.
+        """
+        return [
+            TogglProject.from_json(project)
+            for active in (True, False)
+            for project in self._request(f"workspaces/{self.workspace_id}/projects", {"active": active})
+        ]
 
-    def get_clients_to_projects(self) -> dict[int, set[int]]:
-        clients_to_projects = defaultdict(set)
+    @cache
+    def get_project_index(self) -> ProjectIndex:
+        """Projects change rarely, so their index is kept on disk and downloaded again only after the TTL."""
+        if (cached := load_cache(self._projects_cache_file, self.projects_cache_ttl_sec)) is not None:
+            return ProjectIndex.from_json(cached)
 
-        for project in self.get_projects():
-            clients_to_projects[project.client_id].add(project.id)
+        index = ProjectIndex.from_projects(self.get_projects())
+        save_cache(self._projects_cache_file, index.to_json())
+        return index
 
-        return clients_to_projects
+    def invalidate_projects_cache(self) -> None:
+        invalidate_cache(self._projects_cache_file)
+        self.get_projects.cache_clear()
+        self.get_project_index.cache_clear()
 
     def get_projects_to_client(self) -> dict[int | None, int]:
-        return {project.id: project.client_id for project in self.get_projects()}
+        return self.get_project_index().projects_to_client
 
-    def get_this_week_time_entries(self) -> list[TogglTimeEntry]:
-        today = datetime.today()
-        monday = today - timedelta(days=today.weekday())
-        sunday = monday + timedelta(days=7)
+    def sync_time_entries(self, store: TimeEntryStore, since: datetime) -> None:
+        """Brings `store` up to date with all time entries starting from `since`.
 
-        data = self._request(
-            f"me/time_entries",
-            {"start_date": monday.strftime(API_DATE_FMT), "end_date": sunday.strftime(API_DATE_FMT)},
-        )
+        Changes are pulled incrementally. Entries of the period starting at `since` are downloaded whole only when the
+        store does not cover it yet or when its last repair is older than `FULL_SYNC_INTERVAL_SEC`.
+
+        See https://engineering.toggl.com/docs/api/time_entries#get-timeentries for the `since` parameter, which
+        returns entries modified after a UNIX timestamp, including deleted ones.
+        """
+        synced_at = time.time()
+        last_sync = store.get_state("last_sync")
+        last_full_sync = store.get_state("last_full_sync")
+        synced_from = store.get_state("synced_from")
+
+        if last_sync is None or synced_from is None:
+            store.reset()
+            last_full_sync = synced_from = None
+        else:
+            # Also keeps entries synced before the requested period up to date
+            data = self._request("me/time_entries", {"since": int(last_sync) - SYNC_OVERLAP_SEC})
+            store.apply_changes(TogglTimeEntry.from_json(time_entry) for time_entry in data)
+
+        if (
+            last_full_sync is None
+            or synced_from > since.timestamp()
+            or synced_at - last_full_sync > FULL_SYNC_INTERVAL_SEC
+        ):
+            # Only the requested period is downloaded again, so the cost does not grow with the entries kept from
+            # reports of longer periods
+            tomorrow = datetime.today() + timedelta(days=1)
+            data = self._request(
+                "me/time_entries",
+                {"start_date": since.strftime(API_DATE_FMT), "end_date": tomorrow.strftime(API_DATE_FMT)},
+            )
+            store.replace_time_entries(since, (TogglTimeEntry.from_json(time_entry) for time_entry in data))
+            store.set_state("last_full_sync", synced_at)
+            # Older entries were kept and are still updated with changes, so the store stays complete from there
+            store.set_state("synced_from", min(since.timestamp(), synced_from or since.timestamp()))
 
-        return [TogglTimeEntry(**time_entry) for time_entry in data]
+        store.set_state("last_sync", synced_at)
 
 
 def calculate_duration_in_seconds(
-    time_entries: list[TogglTimeEntry],
-    clients_to_projects: dict[int, set[int]],
-    projects_to_client: dict[int, int],
-) -> tuple[int, defaultdict[str, int], State, int | None]:
-    duration_sec = 0
-    state: State = State.NOT_RUNNING
-    per_day_duration_sec: defaultdict[str, int] = defaultdict(int)
-    client_id = None
-    project_ids = set()
-
-    for time_entry in time_entries:
-        if time_entry.duration < 0:
-            if time_entry.project_id is not None:
-                state = State.RUNNING_WITH_PROJECT
-                client_id = projects_to_client[time_entry.project_id]
-                project_ids = clients_to_projects[client_id]
-            else:
-                state = State.RUNNING_NO_PROJECT
+    store: TimeEntryStore,
+    period: Period,
+    projects_to_client: dict[int, int | None],
+) -> tuple[float, dict[str, float], State, int | None]:
+    if (running_time_entry := store.running_time_entry()) is None:
+        return 0, {}, State.NOT_RUNNING, None
 
-            break
+    if running_time_entry.project_id is None:
+        return 0, {}, State.RUNNING_NO_PROJECT, None
 
-    if state != State.RUNNING_WITH_PROJECT:
-        return duration_sec, per_day_duration_sec, state, client_id
+    client_id = projects_to_client[running_time_entry.project_id]
+    rollup = aggregate(store.durations(period), period, projects_to_client, time.time())
+    return rollup.per_client_sec[client_id], rollup.client_days(client_id), State.RUNNING_WITH_PROJECT, client_id
 
-    for time_entry in time_entries:
-        if time_entry.duration == 0:
-            continue
 
-        if time_entry.project_id not in project_ids:
-            continue
+def secs_to_hours_minutes(secs: float) -> str:
+    """Hours are not wrapped at a day, so weekly and longer totals stay readable."""
+    minutes = int(secs) // 60
+    return f"{minutes // 60}:{minutes % 60:02d}"
 
-        if time_entry.duration > 0:
-            duration = time_entry.duration
-        else:
-            duration = (datetime.now().astimezone() - time_entry.start).total_seconds()
 
-        duration_sec += duration
-        per_day_duration_sec[time_entry.start.strftime(API_DATE_FMT)] += duration
+@dataclasses.dataclass
+class Summary:
+    duration_sec: float
+    per_day_duration_sec: dict[str, float]
+    state: State
+    client_id: int | None
+    computed_at: float
+    # Copied from the settings, so a cached summary can be printed without loading them
+    budget: Budget | None
+    separator: str
+    refresh_interval_sec: float
+
+    def advanced_to(self, timestamp: float) -> "Summary":
+        """The same summary as if computed at `timestamp`, assuming the running timer kept running."""
+        if self.state != State.RUNNING_WITH_PROJECT or timestamp <= self.computed_at:
+            return self
+
+        elapsed_sec = timestamp - self.computed_at
+        today = date.fromtimestamp(timestamp).isoformat()
+        per_day_duration_sec = dict(self.per_day_duration_sec)
+        per_day_duration_sec[today] = per_day_duration_sec.get(today, 0) + elapsed_sec
+        return dataclasses.replace(
+            self,
+            duration_sec=self.duration_sec + elapsed_sec,
+            per_day_duration_sec=per_day_duration_sec,
+            computed_at=timestamp,
+        )
 
-    return duration_sec, per_day_duration_sec, state, client_id
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> "Summary":
+        budget = None if data["budget"] is None else Budget(**data["budget"])
+        return cls(**data | {"state": State(data["state"]), "budget": budget})
 
 
-def secs_to_hours_minutes(secs: int) -> str:
-    return datetime.fromtimestamp(secs, tz=timezone.utc).strftime("%H:%M").removeprefix("0")
+SUMMARY_CACHE_FILE: Final[Path] = CACHE_DIR / "toggl_time_tracked.json"
+REFRESH_LOCK_FILE: Final[Path] = CACHE_DIR / "toggl_time_tracked.lock"
 
 
-def main():
-    api = TogglAPI(workspace_id=settings.WORKSPACE_ID, api_token=settings.API_TOKEN)
+def sync(api: TogglAPI, store: TimeEntryStore, period: Period) -> None:
+    from concurrent.futures import ThreadPoolExecutor
 
-    print(settings.SEPARATOR, end="")
-    time_entries = api.get_this_week_time_entries()
-    clients_to_projects = api.get_clients_to_projects()
-    projects_to_client = api.get_projects_to_client()
+    # The store's connection belongs to this thread, so only the projects are fetched in another one
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        project_index = executor.submit(api.get_project_index)
+        api.sync_time_entries(store, period.since)
+        project_index.result()
+
+    # A project created since the projects were cached
+    if not store.project_ids(period.since) <= api.get_projects_to_client().keys():
+        api.invalidate_projects_cache()
 
-    (
+
+def compute_summary(api: TogglAPI, store: TimeEntryStore, period: Period) -> Summary:
+    computed_at = time.time()
+    sync(api, store, period)
+    duration_sec, per_day_duration_sec, state, client_id = calculate_duration_in_seconds(
+        store, period, api.get_projects_to_client()
+    )
+    summary = Summary(
         duration_sec,
         per_day_duration_sec,
         state,
         client_id,
-    ) = calculate_duration_in_seconds(time_entries, clients_to_projects, projects_to_client)
-
-    if state == State.RUNNING_WITH_PROJECT:
-        if client_id in settings.BUDGETS:
-            budget = settings.BUDGETS[client_id]
-            weekday = datetime.today().isoweekday()
-            elapsed_days = min(weekday, budget.days_per_week)
-            remaining_sec = budget.hours_per_day * 60 * 60 * elapsed_days - duration_sec
+        computed_at,
+        budget=get_settings().BUDGETS.get(client_id),
+        separator=get_settings().SEPARATOR,
+        refresh_interval_sec=get_settings().REFRESH_INTERVAL_SEC,
+    )
+    save_cache(SUMMARY_CACHE_FILE, dataclasses.asdict(summary))
+    return summary
+
+
+def print_summary(summary: Summary) -> None:
+    if summary.state == State.RUNNING_WITH_PROJECT:
+        if summary.budget is not None:
+            today = date.today()
+            expected_sec = summary.budget.expected_seconds(Period.of("week", today).days(until=today))
+            remaining_sec = expected_sec - summary.duration_sec
             if remaining_sec > 0:
                 multiplier = 1
             else:
@@ -185,21 +526,127 @@ def main():
 
             print(secs_to_hours_minutes(remaining_sec * multiplier))
         else:
-            print(secs_to_hours_minutes(duration_sec))
+            print(secs_to_hours_minutes(summary.duration_sec))
     else:
-        print(state)
-
-    if len(argv) >= 2:
-        if argv[1].startswith("-v"):
-            print(
-                "\n".join(
-                    f"{day}: {secs_to_hours_minutes(duration_sec)}"
-                    for day, duration_sec in per_day_duration_sec.items()
-                )
+        print(summary.state)
+
+    if len(argv) >= 2 and argv[1].startswith("-v"):
+        print(
+            "\n".join(
+                f"{day}: {secs_to_hours_minutes(duration_sec)}"
+                for day, duration_sec in summary.per_day_duration_sec.items()
             )
+        )
+
+
+def print_report(rollup: Rollup, projects_to_client: dict[int, int | None], verbose: bool) -> None:
+    """Tracked time of every client in the period, compared with the budget expected until today."""
+    elapsed_days = rollup.period.days(until=date.today())
+    print(f"{rollup.period.start} – {rollup.period.end - timedelta(days=1)}")
+
+    budgets = get_settings().BUDGETS
+    for client_id in sorted(budgets.keys() | rollup.per_client_sec.keys(), key=lambda _: (_ is None, _)):
+        tracked_sec = rollup.per_client_sec.get(client_id, 0)
+        line = f"{'No client' if client_id is None else f'Client {client_id}'}: {secs_to_hours_minutes(tracked_sec)}"
+        if (budget := budgets.get(client_id)) is not None:
+            difference_sec = tracked_sec - budget.expected_seconds(elapsed_days)
+            sign = "-" if difference_sec < 0 else "+"
+            line += f" ({sign}{secs_to_hours_minutes(abs(difference_sec))} against the budget)"
+        print(line)
+
+        if verbose:
+            for project_id, project_sec in rollup.per_project_sec.items():
+                if project_id in projects_to_client and projects_to_client[project_id] == client_id:
+                    print(f"  Project {project_id}: {secs_to_hours_minutes(project_sec)}")
+            for day, day_sec in rollup.client_days(client_id).items():
+                print(f"  {day}: {secs_to_hours_minutes(day_sec)}")
+
+    if rollup.unassigned_sec:
+        print(f"No project: {secs_to_hours_minutes(rollup.unassigned_sec)}")
+
+
+def _spawn_refresh(refresh_interval_sec: float) -> None:
+    """Starts a refresh in its own session, so it outlives this process and the status bar does not wait for it."""
+    try:
+        if time.time() - REFRESH_LOCK_FILE.stat().st_mtime < refresh_interval_sec:
+            return
+    except FileNotFoundError:
+        REFRESH_LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+
+    # The modification time marks the last spawned refresh, even if it is still running or has failed
+    REFRESH_LOCK_FILE.touch()
+    subprocess.Popen(
+        [executable, str(Path(__file__).resolve()), "--refresh"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def print_cached() -> None:
+    """Prints the last summary at once and refreshes it in the background, if it is older than the interval."""
+    now = time.time()
+
+    if (cached := load_cache(SUMMARY_CACHE_FILE)) is None:
+        print(get_settings().SEPARATOR, end="")
+        print("…")
+        _spawn_refresh(get_settings().REFRESH_INTERVAL_SEC)
+        return
+
+    summary = Summary.from_json(cached)
+    print(summary.separator, end="")
+    print_summary(summary.advanced_to(now))
+
+    if now - summary.computed_at >= summary.refresh_interval_sec:
+        _spawn_refresh(summary.refresh_interval_sec)
+
+
+def main():
+    if "--cached" in argv:
+        print_cached()
+        return
+
+    settings = get_settings()
+    api = TogglAPI(
+        workspace_id=settings.WORKSPACE_ID,
+        api_token=settings.API_TOKEN,
+        projects_cache_ttl_sec=settings.PROJECTS_CACHE_TTL_SEC,
+    )
+
+    store = TimeEntryStore(CACHE_DIR / f"toggl_time_entries_{settings.WORKSPACE_ID}.sqlite")
+    period = Period.of("week", date.today())
+
+    if "--refresh-projects" in argv:
+        api.invalidate_projects_cache()
+
+    if "--resync" in argv:
+        store.reset()
+
+    if "--refresh" in argv:
+        # Only one refresh at a time, the others would just repeat the same requests
+        with open(REFRESH_LOCK_FILE, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            compute_summary(api, store, period)
+        return
+
+    if "--report" in argv:
+        kind = next(iter(argv[argv.index("--report") + 1 :]), "week")
+        period = Period.of(kind if kind in PERIODS else "week", date.today())
+        sync(api, store, period)
+        projects_to_client = api.get_projects_to_client()
+        rollup = aggregate(store.durations(period), period, projects_to_client, time.time())
+        print_report(rollup, projects_to_client, verbose="-v" in argv)
+        return
+
+    print(settings.SEPARATOR, end="")
+    print_summary(compute_summary(api, store, period))
 
-        if argv[1].startswith("-vv"):
-            print("\n".join(str(time_entry) for time_entry in sorted(time_entries, key=lambda x: x.start)))
+    if len(argv) >= 2 and argv[1].startswith("-vv"):
+        print("\n".join(str(time_entry) for time_entry in store.time_entries(period.since)))
 
 
 if __name__ == "__main__":
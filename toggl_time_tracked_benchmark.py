@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Compares start-up and parsing time of `toggl_time_tracked.py` with its former pydantic based path.
+
+Start-up is measured as wall time of whole processes: a bare interpreter, importing the libraries every run used
+to import, and printing a cached summary with `--cached`. Parsing is measured on synthetic time entries shaped like
+responses of https://engineering.toggl.com/docs/api/time_entries#get-timeentries.
+
+To run:
+
+python toggl_time_tracked_benchmark.py --entries 100 1000 10000 --runs 20
+"""
+import argparse
+import dataclasses
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable
+
+from pydantic import BaseModel, ConfigDict
+
+import toggl_time_tracked
+from shared.cache import save_cache
+from toggl_models import TogglTimeEntry
+
+
+class PydanticTimeEntry(BaseModel):
+    """The time entry model used before entries were parsed into tuples."""
+
+    project_id: int | None = None
+    duration: int
+    duronly: bool
+    start: datetime
+    stop: datetime | None = None
+    model_config = ConfigDict(extra="ignore")
+
+
+def generate_time_entries(count: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    entries = []
+
+    for index in range(count):
+        start += timedelta(seconds=rng.randint(600, 7200))
+        duration = rng.randint(60, 3600)
+        entries.append(
+            {
+                "id": index,
+                "workspace_id": 1,
+                "project_id": rng.choice([None, *range(1, 20)]),
+                "task_id": None,
+                "billable": rng.random() < 0.5,
+                "start": start.isoformat(),
+                "stop": (start + timedelta(seconds=duration)).isoformat(),
+                "duration": duration,
+                "description": f"Entry {index}",
+                "tags": [],
+                "tag_ids": [],
+                "duronly": True,
+                "at": start.isoformat(),
+                "server_deleted_at": None,
+                "user_id": 1,
+                "uid": 1,
+                "wid": 1,
+            }
+        )
+
+    return json.dumps(entries)
+
+
+def _best_of(function: Callable[[], object], runs: int) -> float:
+    return min(timeit.repeat(function, number=1, repeat=runs))
+
+
+def benchmark_parsing(counts: list[int], runs: int) -> None:
+    print(f"{'Entries':>8} {'pydantic':>10} {'tuples':>10} {'Speed-up':>9}")
+    for count in counts:
+        data = generate_time_entries(count)
+        pydantic_sec = _best_of(lambda: [PydanticTimeEntry(**_) for _ in json.loads(data)], runs)
+        tuples_sec = _best_of(lambda: [TogglTimeEntry.from_json(_) for _ in json.loads(data)], runs)
+        speed_up = pydantic_sec / tuples_sec
+        print(f"{count:>8} {pydantic_sec * 1000:>8.2f}ms {tuples_sec * 1000:>8.2f}ms {speed_up:>8.1f}x")
+
+
+def _process_time(command: list[str], env: dict[str, str], runs: int) -> list[float]:
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, env=env, check=True, stdout=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def benchmark_startup(runs: int) -> None:
+    with tempfile.TemporaryDirectory(prefix="toggl_time_tracked_benchmark_") as workdir:
+        env = os.environ | {"XDG_CACHE_HOME": workdir, "TOGGL_API_TOKEN": "benchmark", "TOGGL_WORKSPACE_ID": "1"}
+        summary = toggl_time_tracked.Summary(
+            duration_sec=3600,
+            per_day_duration_sec={},
+            state=toggl_time_tracked.State.RUNNING_WITH_PROJECT,
+            client_id=1,
+            computed_at=time.time(),
+            budget=None,
+            separator="  |  ",
+            # Never stale, so no refresh is started in the background
+            refresh_interval_sec=365 * 24 * 60 * 60,
+        )
+        save_cache(Path(workdir) / "utility-scripts" / "toggl_time_tracked.json", dataclasses.asdict(summary))
+
+        script = str(Path(toggl_time_tracked.__file__).resolve())
+        commands = {
+            "interpreter": [sys.executable, "-c", "pass"],
+            "former imports": [sys.executable, "-c", "import requests, pydantic, pydantic_settings"],
+            "--cached": [sys.executable, script, "--cached"],
+        }
+
+        print(f"{'Process':<16} {'Median':>9} {'Min':>9}")
+        for name, command in commands.items():
+            durations = _process_time(command, env, runs)
+            print(f"{name:<16} {statistics.median(durations) * 1000:>7.1f}ms {min(durations) * 1000:>7.1f}ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--entries", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    benchmark_startup(args.runs)
+    print()
+    benchmark_parsing(args.entries, args.runs)
+
+
+if __name__ == "__main__":
+    main()
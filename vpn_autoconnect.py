@@ -1,20 +1,49 @@
 import logging
+import math
+import queue
+import random
 import subprocess
 import sys
+import threading
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, time, timedelta
+from functools import cache
 from pathlib import Path
-from time import sleep
-from typing import Never
+from time import monotonic, sleep
+from typing import Callable, Final, Iterable, Iterator, Never
 
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+from shared.cache import CACHE_DIR
+from shared.metrics import Metrics
+from shared.network_state import NMCLI, get_network_state, invalidate_network_state
+
+LOG = logging.getLogger(__name__)
+
+RECONNECT_BACKOFF_MULTIPLIER: Final[float] = 2
+RECONNECT_JITTER: Final[float] = 0.2
+
+MONITOR_RESTART_DELAY_SEC: Final[int] = 5
+# Sleeping does not count time while the machine is suspended, so long sleeps are split to not oversleep a boundary
+MAX_SLEEP_SEC: Final[int] = 60 * 60
+
 
 class Settings(BaseSettings):
     ON_SSIDS: set[str] = Field(default={"*"})
     PROFILE_NAME: str
     RECHECK_INTERVAL_SEC: int = 60
+    # With --events, checks run after NetworkManager events settle and at least once per the safety interval
+    EVENT_DEBOUNCE_SEC: float = 0.2
+    SAFETY_POLL_INTERVAL_SEC: int = 15 * 60
+    # Days of week, where Monday is 0, and local hours when the VPN should be connected
+    WORK_DAYS: set[int] = Field(default={0, 1, 2, 3, 4})
+    WORK_START_HOUR: int = 8
+    WORK_END_HOUR: int = 19
+    # Failed activations are retried after the first delay, doubling up to the max delay
+    RECONNECT_FIRST_DELAY_SEC: float = 2
+    RECONNECT_MAX_DELAY_SEC: float = 5 * 60
+    METRICS_TEXTFILE: Path | None = CACHE_DIR / "vpn_autoconnect.prom"
     LOG_LEVEL: str = "INFO"
 
     model_config = SettingsConfigDict(
@@ -28,31 +57,142 @@ class Settings(BaseSettings):
     def logging_log_level(self) -> int:
         return logging.getLevelNamesMapping()[self.LOG_LEVEL.upper()]
 
+    @property
+    def schedule(self) -> "Schedule":
+        # A day ends at midnight, which as a time of day is the last moment of it
+        end = time.max if self.WORK_END_HOUR == 24 else time(self.WORK_END_HOUR)
+        return Schedule(frozenset(self.WORK_DAYS), time(self.WORK_START_HOUR), end)
+
+
+@dataclass(frozen=True)
+class Schedule:
+    """A daily time window on selected days of week."""
+
+    days: frozenset[int]
+    start: time
+    end: time
+
+    def is_active(self, now: datetime) -> bool:
+        return now.weekday() in self.days and self.start <= now.time() < self.end
+
+    def next_change(self, now: datetime) -> datetime | None:
+        """The next time `is_active` flips, or None if it never does."""
+        if self.is_active(now):
+            return datetime.combine(now.date(), self.end)
+
+        for offset in range(8):
+            day = now.date() + timedelta(days=offset)
+            if day.weekday() in self.days and (start := datetime.combine(day, self.start)) > now:
+                return start
+
+        return None
+
+
+@cache
+def get_metrics() -> Metrics:
+    return Metrics("vpn_autoconnect")
+
+
+class ReconnectScheduler:
+    """Spaces out activation attempts with jittered exponential backoff and measures how long the VPN was down.
+
+    The drop itself is not observed, only the last check that saw the VPN connected. Time to detect and outage
+    duration are therefore upper bounds, as tight as the checks are frequent.
+    """
+
+    def __init__(self, first_delay_sec: float, max_delay_sec: float, clock: Callable[[], float] = monotonic):
+        self._first_delay_sec = first_delay_sec
+        self._max_delay_sec = max_delay_sec
+        self._clock = clock
+        self._last_connected: float | None = None
+        self._detected: float | None = None
+        self._failed_attempts = 0
+        self._next_attempt = 0.0
+
+    def connected(self) -> bool:
+        """Records that the VPN is connected. Returns whether that ended an outage."""
+        now = self._clock()
+        ended_outage = self._detected is not None
+        if ended_outage:
+            metrics = get_metrics()
+            metrics.observe("time_to_connect_seconds", now - self._detected)
+            if self._last_connected is not None:
+                metrics.observe("outage_duration_seconds", now - self._last_connected)
+            metrics.set("last_outage_failed_attempts", self._failed_attempts)
+            LOG.info(
+                f"VPN reconnected {now - self._detected:.1f} seconds after detecting the outage, "
+                f"{self._failed_attempts} activation attempts failed."
+            )
+
+        self._last_connected = now
+        self._reset()
+        return ended_outage
+
+    def disconnected(self) -> None:
+        """Records that the VPN should be, but is not connected."""
+        if self._detected is not None:
+            return
+
+        self._detected = self._clock()
+        if self._last_connected is not None:
+            get_metrics().observe("time_to_detect_seconds", self._detected - self._last_connected)
+
+    def not_wanted(self) -> None:
+        """Forgets any outage, because the VPN is not supposed to be connected, e.g. outside of work hours."""
+        self._last_connected = None
+        self._reset()
+
+    def attempt_failed(self) -> None:
+        self._failed_attempts += 1
+        delay_sec = self._first_delay_sec * RECONNECT_BACKOFF_MULTIPLIER ** (self._failed_attempts - 1)
+        # Jitter keeps retries from staying in lockstep with whatever made the previous attempt fail
+        delay_sec = min(delay_sec, self._max_delay_sec) * random.uniform(1 - RECONNECT_JITTER, 1 + RECONNECT_JITTER)
+        self._next_attempt = self._clock() + delay_sec
+
+    def seconds_until_attempt(self) -> float | None:
+        """None if no outage is being handled, otherwise how long until the next activation attempt."""
+        if self._detected is None:
+            return None
+        return max(self._next_attempt - self._clock(), 0)
+
+    def _reset(self) -> None:
+        self._detected = None
+        self._failed_attempts = 0
+        self._next_attempt = 0.0
+
+
+def seconds_until_next_check(settings: Settings, interval_sec: float, now: datetime) -> float:
+    """Within the schedule, checks repeat every `interval_sec`. Outside of it, nothing can change until it starts."""
+    schedule = settings.schedule
+    if (next_change := schedule.next_change(now)) is None:
+        return interval_sec
+
+    until_change_sec = max((next_change - now).total_seconds(), 0)
+    return min(interval_sec, until_change_sec) if schedule.is_active(now) else min(until_change_sec, MAX_SLEEP_SEC)
+
+
+def _seconds_until_wakeup(settings: Settings, interval_sec: float, reconnect: ReconnectScheduler) -> float:
+    until_attempt_sec = reconnect.seconds_until_attempt()
+    return min(
+        seconds_until_next_check(settings, interval_sec, datetime.now()),
+        math.inf if until_attempt_sec is None else until_attempt_sec,
+    )
 
-LOG = logging.getLogger(__name__)
 
+def export_metrics(settings: Settings) -> None:
+    if settings.METRICS_TEXTFILE is not None:
+        try:
+            get_metrics().export(settings.METRICS_TEXTFILE, None)
+        except OSError as e:
+            LOG.error(f"Error exporting metrics: {e}")
 
-def get_active_autoconnect_wifi_ssid(ssids: set[str]) -> str | None:
-    @dataclass
-    class Connection:
-        active: str
-        ssid: str
 
+def get_active_autoconnect_wifi_ssid(ssids: set[str]) -> str | None:
     try:
-        # Get the list of active connections
-        result = subprocess.run(
-            ["nmcli", "-t", "-f", "ACTIVE,SSID", "dev", "wifi"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-
         # Check if any of the specified SSIDs are active
-        for line in result.stdout.strip().split("\n"):
-            connection = Connection(*line.split(":", maxsplit=2))
-
-            if connection.active == "yes" and (connection.ssid in ssids or not ssids):
-                return connection.ssid
+        for ssid in get_network_state().active_wifi_ssids:
+            if ssid in ssids or not ssids:
+                return ssid
     except Exception as e:
         LOG.error(f"Error checking WiFi connections: {e}")
 
@@ -60,25 +200,9 @@ def get_active_autoconnect_wifi_ssid(ssids: set[str]) -> str | None:
 
 
 def is_vpn_profile_active(vpn_name):
-    @dataclass
-    class Connection:
-        type: str
-        state: str
-        name: str
-
     try:
-        # Get the list of active VPN connections
-        result = subprocess.run(
-            ["nmcli", "-t", "-f", "TYPE,STATE,NAME", "connection", "show", "--active"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-        )
-
         # Check if the specified VPN is active
-        for line in result.stdout.strip().split("\n"):
-            connection = Connection(*line.split(":", maxsplit=3))
-
+        for connection in get_network_state().active_connections:
             if connection.name == vpn_name and connection.type == "vpn" and connection.state == "activated":
                 return True
 
@@ -88,23 +212,35 @@ def is_vpn_profile_active(vpn_name):
     return False
 
 
-def activate_vpn_connection(vpn_name):
+def activate_vpn_connection(vpn_name) -> bool:
     try:
         subprocess.run(
-            ["nmcli", "connection", "up", vpn_name],
+            [NMCLI, "connection", "up", vpn_name],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             text=True,
             check=True,
         )
         LOG.info(f"VPN connection '{vpn_name}' activated successfully.")
+        return True
     except Exception as e:
         LOG.error(f"Error activating VPN connection: {e}")
+        return False
+    finally:
+        invalidate_network_state()
 
 
-def main(settings: Settings) -> None:
+def main(settings: Settings, reconnect: ReconnectScheduler) -> None:
+    # Checked first, because outside of the schedule no nmcli call can change the outcome
+    if not settings.schedule.is_active(datetime.now()):
+        LOG.info("Outside of work hours. Skipping VPN activation.")
+        reconnect.not_wanted()
+        return
+
     if is_vpn_profile_active(settings.PROFILE_NAME):
         LOG.debug(f"'{settings.PROFILE_NAME}' VPN connection is already active.")
+        if reconnect.connected():
+            export_metrics(settings)
         return
 
     if settings.ON_SSIDS == {"*"}:
@@ -114,17 +250,81 @@ def main(settings: Settings) -> None:
         LOG.info("None of the specified WiFi connections to be used for VPN auto-connect are active.")
         LOG.debug(f"Active WiFi connections: {ssid}")
         LOG.debug(f"Auto-connect on WiFi connections: {settings.ON_SSIDS}")
+        reconnect.not_wanted()
         return
 
-    if not ((now := datetime.now()).weekday() < 5 and 8 <= now.hour < 19):
-        LOG.info("Outside of work hours. Skipping VPN activation.")
+    reconnect.disconnected()
+    if wait_sec := reconnect.seconds_until_attempt():
+        LOG.debug(f"Next VPN activation attempt in {wait_sec:.1f} seconds.")
         return
 
     LOG.info(
         f"WiFi connection '{ssid}' is active, set to be used for VPN auto-connect and "
         f"'{settings.PROFILE_NAME}' VPN connection is not active. Activating VPN..."
     )
-    activate_vpn_connection(settings.PROFILE_NAME)
+    if activate_vpn_connection(settings.PROFILE_NAME):
+        if reconnect.connected():
+            export_metrics(settings)
+    else:
+        reconnect.attempt_failed()
+
+
+def nmcli_monitor() -> Iterator[str]:
+    """Streams NetworkManager state changes, one line per change."""
+    with subprocess.Popen(
+        [NMCLI, "monitor"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+    ) as process:
+        try:
+            yield from process.stdout
+        finally:
+            process.terminate()
+
+
+def watch_events(
+    settings: Settings,
+    lines: Iterable[str],
+    reconnect: ReconnectScheduler,
+    check: Callable[[Settings, ReconnectScheduler], None] = main,
+) -> None:
+    """Runs `check` right after each burst of `lines` settles, and when none arrive until the next scheduled check.
+
+    `lines` are read in a thread, so a blocking stream like `nmcli_monitor()` or a fake one can be used. Returns
+    once `lines` ends.
+    """
+    events: queue.Queue[str | None] = queue.Queue()
+
+    def read() -> None:
+        for line in lines:
+            events.put(line)
+        events.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    check(settings, reconnect)
+
+    while True:
+        try:
+            line = events.get(timeout=_seconds_until_wakeup(settings, settings.SAFETY_POLL_INTERVAL_SEC, reconnect))
+        except queue.Empty:
+            LOG.debug("No NetworkManager events since the last scheduled check, checking anyway.")
+            check(settings, reconnect)
+            continue
+
+        ended = line is None
+        if not ended:
+            LOG.debug(f"NetworkManager event: {line.strip()}")
+
+        # One change emits several events, e.g. for the device and each connection. A check after the last is enough.
+        while not ended:
+            try:
+                ended = events.get(timeout=settings.EVENT_DEBOUNCE_SEC) is None
+            except queue.Empty:
+                break
+
+        # Other processes may have cached a snapshot while the change was still settling
+        invalidate_network_state()
+        check(settings, reconnect)
+        if ended:
+            return
 
 
 def main_loop() -> Never:
@@ -135,13 +335,21 @@ def main_loop() -> Never:
         format="[%(levelname)s] %(message)s",
     )
 
+    reconnect = ReconnectScheduler(settings.RECONNECT_FIRST_DELAY_SEC, settings.RECONNECT_MAX_DELAY_SEC)
+
+    if sys.argv[-1] == "--events":
+        while True:
+            watch_events(settings, nmcli_monitor(), reconnect)
+            LOG.warning(f"'nmcli monitor' exited. Restarting it in {MONITOR_RESTART_DELAY_SEC} seconds.")
+            sleep(MONITOR_RESTART_DELAY_SEC)
+
     while True:
-        main(settings)
+        main(settings, reconnect)
 
         if sys.argv[-1] != "--loop":
             break
 
-        sleep(settings.RECHECK_INTERVAL_SEC)
+        sleep(_seconds_until_wakeup(settings, settings.RECHECK_INTERVAL_SEC, reconnect))
 
 
 if __name__ == "__main__":